@@ -0,0 +1,71 @@
+"""
+Compares the old read-everything verification of content tars against the
+streaming single-pass scan in `core.asset.scan_tar`.
+
+Reports wall time per GB and peak Python heap (tracemalloc) for each path.
+
+Usage: python -m benchmarks.asset_hash [size in MB] [member count]
+"""
+import hashlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+from core.asset import scan_tar
+
+
+def make_tar(path: str, size: int, members: int):
+    chunk = os.urandom(size // members)
+    with tarfile.open(path, 'w') as archive:
+        for i in range(members):
+            info = tarfile.TarInfo('frame{}.gif'.format(i))
+            info.size = len(chunk)
+            archive.addfile(info, io.BytesIO(chunk))
+
+
+def read_everything(path: str):
+    """The verification path `Asset.__init__` used before streaming."""
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as archive:
+        hasher.update(archive.read())
+    files = dict()
+    with tarfile.open(path, 'r:*') as archive:
+        for f in archive.getmembers():
+            if f.isfile():
+                files[f.name] = path
+    return hasher.digest(), files
+
+
+def measure(func, path: str):
+    tracemalloc.start()
+    start = time.perf_counter()
+    digest = func(path)[0]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return digest, elapsed, peak
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'content.tar')
+        make_tar(path, size_mb * 1024 * 1024, members)
+        gigabytes = os.path.getsize(path) / (1024 ** 3)
+        print('{} MB, {} members'.format(size_mb, members))
+        results = []
+        for name, func in (('read everything', read_everything), ('streaming', scan_tar)):
+            digest, elapsed, peak = measure(func, path)
+            results.append(digest)
+            print('{:>16}: {:8.3f} s/GB, peak {:8.1f} MB'.format(
+                name, elapsed / gigabytes, peak / (1024 * 1024)))
+        assert results[0] == results[1], 'digests differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Bytes on the wire and CPU time per message, with and without the
+negotiated compression, for typical chat traffic and for a large
+`ServerInfoResponse` listing a busy server's players.
+
+Usage: python -m benchmarks.compression [iterations]
+"""
+import random
+import sys
+import time
+
+from network import codec, packets
+
+
+def chat_messages(count: int):
+    rng = random.Random(0)
+    words = "objection hold it take that witness testimony evidence court the a is was not".split()
+    return [packets.Chat(room_id=1, text=" ".join(rng.choice(words) for _ in range(rng.randint(2, 25))),
+                         emote="emote{}".format(rng.randint(1, 9)), preanimation=None)
+            for _ in range(count)]
+
+
+def server_info(players: int):
+    details = packets.ServerInfoResponse.Details(
+        desc="A busy courtroom",
+        players=[{'name': "Player {}".format(i), 'character_name': "Character {}".format(i % 40),
+                  'join_time': 1500000000 + i * 37} for i in range(players)])
+    return packets.ServerInfoResponse("Courtroom", "127.0.0.1", 27017, "1.0", players, 500,
+                                      packets.ServerInfoResponse.Protection.OPEN, auth_challenge=bytes(16),
+                                      details=details, compression=codec.COMPRESSION)
+
+
+def measure(messages, compress: bool, iterations: int):
+    """Get (bytes per message, encode us per message, decode us per message)."""
+    frames = [codec.encode(message, compress) for message in messages]
+    size = sum(len(frame) for frame in frames) / len(frames)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            codec.encode(message, compress)
+    encode_time = (time.perf_counter() - start) / (iterations * len(messages))
+
+    decoder = codec.MessageDecoder()
+    decoder.compression = compress
+    stream = b''.join(frames)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decoder.feed(stream)
+    decode_time = (time.perf_counter() - start) / (iterations * len(messages))
+    return size, encode_time * 1e6, decode_time * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    cases = (('chat', chat_messages(1000), iterations),
+             ('server info, 50 players', [server_info(50)], iterations * 50),
+             ('server info, 500 players', [server_info(500)], iterations * 5))
+    for name, messages, count in cases:
+        print(name)
+        for compress in (False, True):
+            size, encode_us, decode_us = measure(messages, compress, count)
+            print('  {:<5} {:9.0f} bytes/msg, encode {:8.1f} us, decode {:8.1f} us'.format(
+                'zlib' if compress else 'plain', size, encode_us, decode_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Feeds 100k length-prefixed msgpack messages, split into random chunk
+sizes, through the framing used by `ClientProtocol.data_received` before
+and after `network.framing.FrameDecoder`.
+
+Only framing is timed: each frame is handed to `len` instead of msgpack,
+since decoding costs the same on both paths.
+
+Usage: python -m benchmarks.framing [message count] [max chunk size]
+"""
+import random
+import struct
+import sys
+import time
+
+from network import packets
+from network.framing import FrameDecoder, HEADER
+
+
+def make_stream(count: int) -> bytes:
+    stream = bytearray()
+    for i in range(count):
+        payload = packets.Chat(room_id=1, text="message {}".format(i),
+                               emote="emote1", preanimation=None).encode()
+        stream += HEADER.pack(len(payload)) + payload
+    return bytes(stream)
+
+
+def chunk(stream: bytes, max_chunk: int, seed: int = 0):
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.randint(1, max_chunk)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+class RecursiveFraming:
+    """The framing `ClientProtocol.data_received` used before FrameDecoder."""
+
+    def __init__(self):
+        self._buffer = None
+        self.received = 0
+
+    def data_received(self, data: bytes):
+        if self._buffer is not None:
+            self._buffer += data
+        else:
+            self._buffer = bytearray(data)
+        # Unlike the original, guard against a partial header so the
+        # comparison can run at all.
+        if len(self._buffer) < 4:
+            return
+        msg_size = struct.unpack_from("<I", self._buffer)[0]
+        if len(self._buffer) >= msg_size + 4:
+            len(self._buffer[4:msg_size + 4])
+            self.received += 1
+            remaining = self._buffer[msg_size + 4:]
+            self._buffer = None
+            self.data_received(remaining)
+
+
+def run_recursive(chunks) -> int:
+    framing = RecursiveFraming()
+    for data in chunks:
+        framing.data_received(data)
+    return framing.received
+
+
+def run_decoder(chunks) -> int:
+    decoder = FrameDecoder()
+    received = 0
+    for data in chunks:
+        decoder.feed(data)
+        for _, frame in decoder:
+            len(frame)
+            received += 1
+    return received
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    max_chunk = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    chunks = chunk(make_stream(count), max_chunk)
+    print('{} messages in {} chunks of up to {} bytes'.format(count, len(chunks), max_chunk))
+    for name, func in (('recursive', run_recursive), ('FrameDecoder', run_decoder)):
+        start = time.perf_counter()
+        try:
+            received = func(chunks)
+        except RecursionError:
+            print('{:>13}: hit the recursion limit'.format(name))
+            continue
+        elapsed = time.perf_counter() - start
+        assert received == count, '{} received {} messages'.format(name, received)
+        print('{:>13}: {:8.3f} s, {:10.0f} msg/s'.format(name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Load generator: many simulated players, each a `network.client.client.Client`,
+run a scripted scenario against a server.
+
+Every player connects, gets the server info, joins the server and a room
+(round-robin over the rooms), then sends at a steady rate for the length
+of the run:
+
+    chat:   ChatMessage requests
+    sound:  SoundPlay packets, relayed to the whole room
+    mixed:  four chat messages for every sound
+
+Sending is open-loop: a player does not wait for one message to be
+answered before sending the next, so a slow server shows up as latency
+rather than as a lower sending rate. Two latencies are measured:
+
+    response: from sending a ChatMessage until its echo comes back
+    delivery: from sending a message until a room member receives it
+              (the send time travels in the message text or sound name)
+
+Players are spread over several driver processes, each running one
+event loop. Unless --connect is given, the server is started locally,
+as a single process or sharded (--workers), and its CPU use and peak
+RSS over the run are reported (Linux only, from /proc).
+
+Usage: python -m benchmarks.loadgen [options]  (see --help)
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import time
+
+from network import packets
+from network.exceptions import ProtocolError, RequestRejected
+from network.client.client import Client, ClientHandler
+from network.server.admission import Admission
+from network.server.server import Server, Room
+from network.server.sharded import Supervisor
+
+SCENARIOS = 'chat', 'sound', 'mixed'
+
+# Handshakes in flight at once per driver, so the server's handshake
+# deadline is not spent waiting in its accept queue
+CONNECT_CONCURRENCY = 64
+
+# Most latency samples a driver keeps of each kind
+MAX_SAMPLES = 100000
+
+
+class Samples:
+    """A uniform sample of at most `limit` values (reservoir sampling)."""
+
+    def __init__(self, limit: int = MAX_SAMPLES):
+        self.limit = limit
+        self.count = 0
+        self.values = []
+        self._rng = random.Random()
+
+    def add(self, value: float):
+        self.count += 1
+        if len(self.values) < self.limit:
+            self.values.append(value)
+        else:
+            i = self._rng.randrange(self.count)
+            if i < self.limit:
+                self.values[i] = value
+
+
+class SimulatedPlayer(ClientHandler):
+    """Counts what a player receives and how long it took to get there."""
+
+    def __init__(self, client, delivery: Samples):
+        super().__init__(client)
+        self.player_id = None
+        self.disconnected = None
+        self.received = 0
+        self.delivery = delivery
+
+    def handle_message(self, msg):
+        msgid = msg['id']
+        if msgid == 'ChatMessage':
+            # Responses to our own messages are timed by the request
+            if msg.get('player_id') != self.player_id:
+                self.received += 1
+                self._delivered(msg.get('text'))
+        elif msgid == 'SoundPlay':
+            self.received += 1
+            self._delivered(msg.get('name'))
+
+    def _delivered(self, stamp):
+        try:
+            self.delivery.add(time.time() - float(stamp))
+        except (TypeError, ValueError):
+            pass
+
+
+class Driver:
+    """The players of one driver process, and what they measured."""
+
+    def __init__(self, options, driver: int):
+        self.options = options
+        self.driver = driver
+        self.players = []
+        self.response = Samples()
+        self.delivery = Samples()
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.mismatched = 0
+        self.failed = 0
+        self._rng = random.Random(driver)
+
+    async def connect(self, index: int, limit: asyncio.Semaphore):
+        options = self.options
+        client = Client(options.host, options.port)
+        player = SimulatedPlayer(client, self.delivery)
+        client.handler = player
+        number = self.driver * options.clients + index
+        room_id = number % options.rooms + 1
+        player.disconnected = asyncio.get_event_loop().create_future()
+        async with limit:
+            try:
+                await client.connect(player.disconnected)
+                await client.get_server_info()
+                joined = await client.join_server("load{}".format(number), options.password)
+                await client.join_room(room_id)
+            except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+                self.failed += 1
+                if self.failed == 1:
+                    print("driver {}: player {} could not join: {!r}".format(self.driver, number, e))
+                client.close()
+                return
+        player.player_id = joined.get('player_id')
+        self.players.append((client, room_id))
+
+    async def connect_all(self):
+        limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        await asyncio.gather(*(self.connect(i, limit) for i in range(self.options.clients)))
+
+    async def chat(self, client: Client, room_id: int):
+        start = time.perf_counter()
+        message = packets.Chat(room_id=room_id, text="{:.6f}".format(time.time()),
+                               emote="normal", preanimation=None)
+        try:
+            response = await client.request(message, packets.Chat, timeout=self.options.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.timeouts += 1
+            return
+        except RequestRejected:
+            self.rejected += 1
+            return
+        if response['text'] != message.text:
+            # Answered with someone else's message: the timing would be wrong
+            self.mismatched += 1
+            return
+        self.answered += 1
+        self.response.add(time.perf_counter() - start)
+
+    async def play(self, client: Client, room_id: int, end: float):
+        options = self.options
+        interval = 1.0 / options.rate
+        loop = asyncio.get_event_loop()
+        pending = set()
+        # Spread the players' sends over the first interval
+        next_send = loop.time() + self._rng.random() * interval
+        while next_send < end and not client.handler.disconnected.done():
+            await asyncio.sleep(next_send - loop.time())
+            next_send += interval
+            self.sent += 1
+            scenario = options.scenario
+            if scenario == 'mixed':
+                scenario = 'sound' if self._rng.random() < 0.2 else 'chat'
+            if scenario == 'chat':
+                task = asyncio.ensure_future(self.chat(client, room_id))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            else:
+                client.write(packets.SoundPlay("{:.6f}".format(time.time()), channel=0))
+        if pending:
+            await asyncio.wait(pending)
+
+    async def run(self):
+        end = asyncio.get_event_loop().time() + self.options.duration
+        await asyncio.gather(*(self.play(client, room_id, end) for client, room_id in self.players))
+        # Let the last broadcasts arrive
+        await asyncio.sleep(0.5)
+        received = sum(client.handler.received for client, _ in self.players)
+        for client, _ in self.players:
+            client.close()
+        return {
+            'connected': len(self.players),
+            'failed': self.failed,
+            'sent': self.sent,
+            'answered': self.answered,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'mismatched': self.mismatched,
+            'received': received,
+            'response': self.response.values,
+            'delivery': self.delivery.values,
+        }
+
+
+def raise_file_limit():
+    """Allow as many open files as the hard limit does."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_driver(options, driver: int, barrier, results):
+    raise_file_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    players = Driver(options, driver)
+    loop.run_until_complete(players.connect_all())
+    # Start sending together with the other drivers
+    barrier.wait()
+    results.put(loop.run_until_complete(players.run()))
+    loop.close()
+
+
+def run_server(options, ready):
+    raise_file_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    total = options.clients * options.processes
+    # Every player connects from this machine and sends as fast as the scenario says
+    admission = Admission(max_per_ip=total, max_connections=total,
+                          chat_rate=options.rate * 2, chat_burst=max(10, options.rate * 2))
+    kwargs = dict(address=options.host, port=options.port, max_players=total, password=options.password,
+                  rooms=[Room(i, "Room {}".format(i)) for i in range(1, options.rooms + 1)],
+                  admission=admission)
+    server = Supervisor(workers=options.workers, **kwargs) if options.workers else Server(**kwargs)
+    loop.run_until_complete(server.start())
+    ready.set()
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+
+
+def process_tree(pid: int) -> list:
+    """Get `pid` and its descendants, or [] where /proc cannot tell."""
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+    return [pid] + [descendant for child in children for descendant in process_tree(child)]
+
+
+def cpu_seconds(pids: list) -> float:
+    """User + system CPU time used so far by the processes."""
+    ticks = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                # Skip the command name, which may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def peak_rss(pids: list) -> int:
+    """Sum of the processes' peak resident set sizes, in bytes."""
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def percentile(values: list, fraction: float) -> float:
+    """`values` must be sorted."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadgen", description=__doc__.split("\n\n")[0])
+    parser.add_argument('--clients', type=int, default=500, help="players per driver process")
+    parser.add_argument('--processes', type=int, default=1, help="driver processes")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending")
+    parser.add_argument('--rate', type=float, default=1.0, help="messages per second per player")
+    parser.add_argument('--scenario', choices=SCENARIOS, default='chat')
+    parser.add_argument('--rooms', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds to wait for a response")
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="run the local server sharded over this many workers (0: single process)")
+    parser.add_argument('--connect', metavar='HOST:PORT', default=None,
+                        help="load an already running server instead of starting one")
+    options = parser.parse_args(args)
+    if options.connect is not None:
+        options.host, _, port = options.connect.rpartition(':')
+        options.port = int(port)
+    else:
+        options.host, options.port = '127.0.0.1', free_port()
+    return options
+
+
+def report(options, results: list, seconds: float, cpu: float = None, rss: int = None):
+    """`cpu` is the share of a core the server used, `rss` its peak memory."""
+    total = lambda key: sum(result[key] for result in results)
+    players = options.clients * options.processes
+    print("{} scenario, {} players over {} driver(s), {} rooms, {:g} msg/s each, {:g} s".format(
+        options.scenario, players, options.processes, options.rooms, options.rate, options.duration))
+    print("joined:     {:>10} ({} failed)".format(total('connected'), total('failed')))
+    print("sent:       {:>10.0f} msg/s".format(total('sent') / seconds))
+    print("received:   {:>10.0f} msg/s (broadcasts delivered)".format(total('received') / seconds))
+    if total('answered') or total('timeouts') or total('rejected'):
+        print("answered:   {:>10} ({} rejected, {} timed out)".format(
+            total('answered'), total('rejected'), total('timeouts')))
+    if total('mismatched'):
+        print("MISMATCHED: {:>10} responses were not to the request sent".format(total('mismatched')))
+    for kind in 'response', 'delivery':
+        values = sorted(value for result in results for value in result[kind])
+        if values:
+            print("{:<9}   p50 {:8.2f} ms   p99 {:8.2f} ms   max {:8.2f} ms".format(
+                kind + ":", percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, values[-1] * 1000))
+    if cpu is not None:
+        print("server CPU: {:>10.0f} % of a core".format(cpu * 100))
+    if rss:
+        print("server RSS: {:>10.1f} MB peak".format(rss / 1024 / 1024))
+
+
+def main(args=None):
+    options = parse_args(args)
+    context = multiprocessing.get_context('fork')
+    server = None
+    if options.connect is None:
+        ready = context.Event()
+        server = context.Process(target=run_server, args=(options, ready))
+        server.start()
+        ready.wait()
+    barrier = context.Barrier(options.processes + 1)
+    results = context.Queue()
+    drivers = [context.Process(target=run_driver, args=(options, i, barrier, results))
+               for i in range(options.processes)]
+    for driver in drivers:
+        driver.start()
+    try:
+        barrier.wait()
+        pids = process_tree(server.pid) if server is not None else []
+        cpu = cpu_seconds(pids)
+        start = time.perf_counter()
+        collected = [results.get() for _ in drivers]
+        seconds = time.perf_counter() - start
+        cpu = cpu_seconds(pids) - cpu
+        rss = peak_rss(pids)
+        for driver in drivers:
+            driver.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+    # The drivers also waited for stragglers, so rates are over the sending time
+    report(options, collected, options.duration, cpu / seconds if pids else None, rss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Time taken by a lobby to download the master server's list
+(`network.master.client.MasterClient.refresh`), in full and as a delta
+after a few listings changed, for lists of different lengths. The
+longer lists are above the default limits on what a game server may
+send, which the master server's responses are not held to.
+
+Usage: python -m benchmarks.master_list [listing counts...]
+"""
+import asyncio
+import sys
+import time
+
+from network import packets
+from network.master.client import MasterClient
+from network.master.server import MasterServer
+
+CHANGED = 10
+
+
+def heartbeat(i: int) -> dict:
+    """A heartbeat as the master server decodes it."""
+    beat = packets.Heartbeat(27017, "Courtroom {}".format(i), "A busy courtroom", "1.0", i % 100, 100, 0)
+    return {name: getattr(beat, name) for name in packets.Heartbeat.fields}
+
+
+async def measure(count: int):
+    """Get (ms for a full refresh, ms for a delta refresh)."""
+    master = MasterServer('127.0.0.1', 0)
+    await master.start()
+    port = master.server.sockets[0].getsockname()[1]
+    for i in range(count):
+        master.servers.update("10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255), heartbeat(i))
+    client = MasterClient('127.0.0.1', port)
+    try:
+        await client.connect()
+        start = time.perf_counter()
+        await client.refresh()
+        full_time = time.perf_counter() - start
+        if len(client.servers) != count:
+            raise AssertionError("Got {} listings of {}".format(len(client.servers), count))
+        for i in range(CHANGED):
+            master.servers.update("10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255),
+                                  dict(heartbeat(i), max_players=200))
+        start = time.perf_counter()
+        changed, _ = await client.refresh()
+        delta_time = time.perf_counter() - start
+        if len(changed) != CHANGED:
+            raise AssertionError("Got {} changed listings of {}".format(len(changed), CHANGED))
+    finally:
+        client.close()
+        master.close()
+    return full_time * 1000, delta_time * 1000
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 50000]
+    for count in counts:
+        full_ms, delta_ms = asyncio.run(measure(count))
+        print('{:>6} listings: full {:8.1f} ms, delta of {} {:6.1f} ms'.format(count, full_ms, CHANGED, delta_ms))
+
+
+if __name__ == '__main__':
+    main()
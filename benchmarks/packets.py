@@ -0,0 +1,81 @@
+"""
+Encode/decode throughput of `Chat`, `SoundPlay` and `Join` packets with
+the precomputed per-class encoders, against the previous path that
+packed each packet's `__dict__` and unpacked every message with a fresh
+`msgpack.unpackb`.
+
+Usage: python -m benchmarks.packets [iterations]
+"""
+import sys
+import time
+
+import msgpack
+
+from network import codec, packets
+
+
+def make_packets():
+    return [
+        packets.Chat(room_id=1, text="Objection! The witness is lying.",
+                     emote="pointing", preanimation=None),
+        packets.SoundPlay("objection", 2, loop=False),
+        packets.Join(42, "Phoenix", "phoenix_wright"),
+    ]
+
+
+class DictPacket:
+    """A packet as it used to be stored: its id and fields in `__dict__`."""
+
+    def __init__(self, packet: packets.Packet):
+        self.id = packet.msgid
+        for name in packet.fields:
+            setattr(self, name, getattr(packet, name))
+
+    def encode(self):
+        packets.logger.debug("writing: %s", self.__dict__)
+        return msgpack.packb(self.__dict__, use_bin_type=True)
+
+
+def timed(func, iterations: int) -> float:
+    start = time.perf_counter()
+    func(iterations)
+    return time.perf_counter() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for packet in make_packets():
+        old = DictPacket(packet)
+        assert msgpack.unpackb(old.encode(), encoding='utf-8') == \
+            msgpack.unpackb(packet.encode(), encoding='utf-8')
+        payload = packet.encode()
+        frame = codec.encode(packet)
+
+        def encode_old(n):
+            for _ in range(n):
+                old.encode()
+
+        def encode_new(n):
+            for _ in range(n):
+                packet.encode()
+
+        def decode_old(n):
+            for _ in range(n):
+                msgpack.unpackb(payload, encoding='utf-8')
+
+        def decode_new(n):
+            decoder = codec.MessageDecoder()
+            for _ in range(n):
+                decoder.feed(frame)
+
+        print('{} ({} bytes), {} iterations (new decode includes framing and limit checks)'.format(type(packet).__name__, len(payload), iterations))
+        for name, old_func, new_func in (('encode', encode_old, encode_new),
+                                         ('decode', decode_old, decode_new)):
+            old_time = timed(old_func, iterations)
+            new_time = timed(new_func, iterations)
+            print('  {}: {:10.0f} -> {:10.0f} msg/s ({:.2f}x)'.format(
+                name, iterations / old_time, iterations / new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
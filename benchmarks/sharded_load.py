@@ -0,0 +1,127 @@
+"""
+Chat throughput of the sharded server (`network.server.sharded`) with
+different numbers of workers.
+
+Clients, spread over several driver processes, join rooms round-robin
+and send chat messages back to back for a while. Throughput is the
+number of chat messages delivered to clients (echoes and broadcasts)
+per second. The drivers compete with the server for cores, so run this
+on a machine with more cores than workers + drivers.
+
+Usage: python -m benchmarks.sharded_load [seconds] [worker counts...]
+"""
+import asyncio
+import multiprocessing
+import socket
+import sys
+import time
+
+from network.client.client import Client, ClientHandler
+from network.server.admission import Admission
+from network.server.server import Room
+from network.server.sharded import Supervisor
+
+ROOMS = 16
+DRIVERS = 4
+CLIENTS_PER_DRIVER = 16
+
+
+class CountingHandler(ClientHandler):
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.received = 0
+
+    def handle_message(self, msg):
+        if msg['id'] == 'ChatMessage':
+            self.received += 1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_server(port: int, workers: int, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # All clients connect from here and chat as fast as they can
+    admission = Admission(max_per_ip=DRIVERS * CLIENTS_PER_DRIVER, chat_rate=1e9, chat_burst=1e9)
+    server = Supervisor(workers=workers, address='127.0.0.1', port=port, max_players=10000,
+                        rooms=[Room(i, "Room {}".format(i)) for i in range(1, ROOMS + 1)], admission=admission)
+    loop.run_until_complete(server.start())
+    ready.set()
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+
+
+async def drive(port: int, driver: int, start_at: float, seconds: float) -> int:
+    clients = []
+    for i in range(CLIENTS_PER_DRIVER):
+        client = Client('127.0.0.1', port)
+        client.handler = CountingHandler(client)
+        await client.connect()
+        await client.get_server_info()
+        await client.join_server("load{}-{}".format(driver, i))
+        room_id = (driver * CLIENTS_PER_DRIVER + i) % ROOMS + 1
+        await client.join_room(room_id)
+        clients.append((client, room_id))
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    before = sum(client.handler.received for client, _ in clients)
+
+    async def chat(client, room_id):
+        end = start_at + seconds
+        while time.time() < end:
+            await client.send_message(room_id=room_id, text="Objection!", emote="pointing")
+
+    await asyncio.gather(*(chat(client, room_id) for client, room_id in clients))
+    received = sum(client.handler.received for client, _ in clients) - before
+    for client, _ in clients:
+        client.close()
+    return received
+
+
+def run_driver(port: int, driver: int, start_at: float, seconds: float, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results.put(loop.run_until_complete(drive(port, driver, start_at, seconds)))
+
+
+def measure(workers: int, seconds: float) -> float:
+    context = multiprocessing.get_context('fork')
+    port = free_port()
+    ready = context.Event()
+    server = context.Process(target=run_server, args=(port, workers, ready))
+    server.start()
+    ready.wait()
+    results = context.Queue()
+    # Leave the drivers time to connect and join before they all start
+    start_at = time.time() + 2.0
+    drivers = [context.Process(target=run_driver, args=(port, i, start_at, seconds, results))
+               for i in range(DRIVERS)]
+    for driver in drivers:
+        driver.start()
+    received = sum(results.get() for _ in drivers)
+    for driver in drivers:
+        driver.join()
+    server.terminate()
+    server.join()
+    return received / seconds
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    worker_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4]
+    print('{} rooms, {} clients, {} s per run'.format(ROOMS, DRIVERS * CLIENTS_PER_DRIVER, seconds))
+    baseline = None
+    for workers in worker_counts:
+        throughput = measure(workers, seconds)
+        baseline = baseline or throughput
+        print('{:>2} workers: {:10.0f} msg/s ({:.2f}x)'.format(workers, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main()
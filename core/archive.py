@@ -0,0 +1,133 @@
+import io
+import mmap
+import tarfile
+import threading
+
+# Maps tar paths to [mmap, reference count], so that every reader of the
+# same tar (e.g. characters inheriting from one parent) shares one mapping.
+_maps = dict()
+_maps_lock = threading.Lock()
+
+
+def _acquire_map(path: str) -> mmap.mmap:
+    with _maps_lock:
+        entry = _maps.get(path)
+        if entry is None:
+            with open(path, 'rb') as f:
+                entry = _maps[path] = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _release_map(path: str):
+    with _maps_lock:
+        entry = _maps[path]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _maps[path]
+    try:
+        entry[0].close()
+    except BufferError:
+        # Member views are still alive; the mapping goes away with them.
+        pass
+
+
+class MemberFile(io.RawIOBase):
+    """
+    Seekable, read-only file object over a memoryview of an archive
+    member. Reads copy only the bytes asked for.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        end = min(self._pos + len(b), len(self._view))
+        size = end - self._pos
+        b[:size] = self._view[self._pos:end]
+        self._pos = end
+        return size
+
+    def readall(self):
+        data = self._view[self._pos:].tobytes()
+        self._pos = len(self._view)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+class ArchiveReader:
+    """
+    Read-only access to the members of a content tar.
+
+    Uncompressed tars that come with a member index (name to offset and
+    size) are memory-mapped once per process and members are handed out as
+    memoryview slices of the mapping, so opening one never walks the tar
+    headers or copies a member up front. Anything else falls back to
+    tarfile.
+    """
+
+    def __init__(self, path: str, index: dict = None):
+        self.path = path
+        self.index = index
+        self._map = None
+        self._tar = None
+        if index is not None:
+            self._map = _acquire_map(path)
+        else:
+            self._tar = tarfile.open(path, 'r:*')
+
+    def open_member(self, name: str) -> memoryview:
+        """
+        Get a zero-copy view of a member. Only available for indexed tars.
+        Release the view before closing the reader.
+        """
+        if self._map is None:
+            raise ValueError("{} is not memory-mapped".format(self.path))
+        try:
+            offset, size = self.index[name]
+        except KeyError:
+            raise KeyError("filename {!r} not found".format(name))
+        return memoryview(self._map)[offset:offset + size]
+
+    def extractfile(self, name: str):
+        """Get a file object for a member, like `TarFile.extractfile`."""
+        if self._tar is not None:
+            return self._tar.extractfile(name)
+        return MemberFile(self.open_member(name))
+
+    def close(self):
+        if self._map is not None:
+            self._map = None
+            _release_map(self.path)
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,64 +1,190 @@
 import hashlib
 import os
 import tarfile
+from collections import ChainMap
 
+from .archive import ArchiveReader
+from .cache import VerificationCache
 from .exceptions import BadHashError, MissingEntryError
+from .registry import AssetRegistry
 import msgpack
 
+# Size of each read when streaming a content tar through the hasher.
+CHUNK_SIZE = 1024 * 1024
+
+
+class _HashingReader:
+    """
+    Wraps a binary file so that every byte read through it is fed to
+    `hasher`. This lets tarfile walk the member headers while the
+    checksum is being computed, so the archive is only read once.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def drain(self):
+        """Hash whatever tarfile left unread (end-of-archive padding)."""
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            size = self.fileobj.readinto(buf)
+            if not size:
+                break
+            self.hasher.update(view[:size])
+
+
+# Magic numbers of the compression formats tarfile can read.
+COMPRESSION_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')
+
+
+def scan_tar(path: str):
+    """
+    Hash a tar and index its members in a single sequential pass.
+    Returns the SHA-1 digest, a dictionary mapping each regular file's
+    name to its `(offset, size)` inside the uncompressed archive, and
+    whether the archive is compressed (in which case the offsets cannot
+    be used to seek in the file itself).
+    """
+    # Future: self.info.hash_type might indicate something other than sha1
+    hasher = hashlib.sha1()
+    index = dict()
+    with open(path, 'rb') as raw:
+        compressed = raw.read(6).startswith(COMPRESSION_MAGIC)
+        raw.seek(0)
+        reader = _HashingReader(raw, hasher)
+        # Stream mode only ever reads forward, which is what allows the
+        # reader to see every byte exactly once.
+        with tarfile.open(fileobj=reader, mode='r|*', bufsize=CHUNK_SIZE) as archive:
+            for f in archive:
+                if f.isfile():
+                    index[f.name] = (f.offset_data, f.size)
+        reader.drain()
+    return hasher.digest(), index, compressed
+
 
 class Asset:
     category = ''
 
-    def __init__(self, id: str):
-        """Load asset information by ID."""
+    # Maps attributes parsed on first access to the methods that set them.
+    lazy_attributes = {
+        'manifest': '_unpack_manifest'
+    }
+
+    def __init__(self, id: str, paranoid: bool = False, registry: AssetRegistry = None):
+        """
+        Load asset information by ID.
+        Content tars that were already verified and have not changed since
+        are not hashed again, unless `paranoid` is set.
+        Parents are resolved through `registry`, so assets sharing a parent
+        should be obtained with `AssetRegistry.get` rather than constructed
+        directly.
+        """
         self.id = id
-        self.path = os.path.join(os.getcwd(), 'assets', self.category, id)
+        self.path = self.asset_path(id)
         self.info_path = os.path.join(self.path, 'info.mp')
         self.content_tar_path = os.path.join(self.path, 'content.tar')
         self.content_tar_paths = [self.content_tar_path]
         self.content_tars = None
+        # Maps tar paths to member indexes, or None if it must be scanned
+        self.tar_indexes = dict()
 
         # Load asset info
-        with open(self.info_path, 'rb') as info_json:
-            self.info = msgpack.unpackb(info_json.read(), encoding='utf-8')
-
-        # Recursive: get parent data
-        # Can result in an infinite loop
-        try:
-            self.parent = self.__class__(self.info['parent'])
-            self.files = self.parent.files
+        self.info = self.read_info(id)
+
+        # Recursive: get parent data (the registry detects cycles)
+        if registry is None:
+            registry = AssetRegistry(paranoid)
+        self.registry = registry
+        # Whether any lazy attribute has been parsed yet
+        self._touched = False
+        if 'parent' in self.info:
+            self.parent = registry.get(self.__class__, self.info['parent'])
+            # Mapping of paths to tar paths. Our own files go into the first
+            # map, so the parent's map is shared rather than copied.
+            self.files = self.parent.files.new_child()
             self.content_tar_paths += self.parent.content_tar_paths
-            del self.parent
-        except KeyError:
-            # Create a dictionary mapping of paths to tar paths
-            self.files = dict()
-
-        # Read once to verify hash
-        # Future: self.info.hash_type might indicate something other than sha1
-        hasher = hashlib.sha1()
-        with open(self.content_tar_path, 'rb') as archive:
-            hasher.update(archive.read())
-        checksum = hasher.digest()
-        if checksum != bytearray.fromhex(self.info['hash']):
-            raise BadHashError()
-
-        # Read again to get the files
-        with tarfile.open(self.content_tar_path, 'r:*') as archive:
-            for f in archive.getmembers():
-                if f.isfile():
-                    self.files[f.name] = self.content_tar_path
+            self.tar_indexes.update(self.parent.tar_indexes)
+        else:
+            self.parent = None
+            self.files = ChainMap()
+
+        expected = bytes.fromhex(self.info['hash'])
+        cache = VerificationCache()
+        identity = cache.identity(self.content_tar_path)
+        cached = None
+        if not paranoid:
+            cached = cache.lookup(self.content_tar_path, identity, expected)
+        if cached is not None:
+            # Unchanged since it was last verified: use the stored index
+            index, compressed = cached
+        else:
+            # Verify the hash and get the files in one read
+            checksum, index, compressed = scan_tar(self.content_tar_path)
+            if checksum != expected:
+                raise BadHashError()
+            cache.store(self.content_tar_path, identity, checksum, index, compressed)
+        self.tar_indexes[self.content_tar_path] = None if compressed else index
+        for name in index:
+            self.files[name] = self.content_tar_path
+
+    @classmethod
+    def asset_path(cls, id: str) -> str:
+        """Get the directory of an asset of this type."""
+        return os.path.join(os.getcwd(), 'assets', cls.category, id)
+
+    @classmethod
+    def read_info(cls, id: str) -> dict:
+        """Read an asset's info without verifying or loading anything else."""
+        with open(os.path.join(cls.asset_path(id), 'info.mp'), 'rb') as info_json:
+            return msgpack.unpackb(info_json.read(), encoding='utf-8')
+
+    @classmethod
+    def installed(cls) -> list:
+        """Get the IDs of all installed assets of this type."""
+        root = cls.asset_path('')
+        try:
+            names = os.listdir(root)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if os.path.isfile(os.path.join(root, name, 'info.mp'))]
 
     def load(self):
         """
         Load an asset's resources for in-game use.
-        This should be handled by child asset formats.
+
+        Assets are lazy: every entry of `lazy_attributes` is parsed the
+        first time it is accessed, so calling this is only needed to pay
+        the whole cost up front (and surface manifest errors early).
         """
+        for name in self.lazy_attributes:
+            getattr(self, name)
+
+    def __getattr__(self, name):
+        # Only reached when the attribute has not been set yet.
+        parser = type(self).lazy_attributes.get(name)
+        if parser is None:
+            raise AttributeError("{!r} object has no attribute {!r}".format(type(self).__name__, name))
+        if not self._touched:
+            self._touched = True
+            self.registry.touch(self)
+        try:
+            getattr(self, parser)()
+        except KeyError:
+            raise MissingEntryError()
+        return self.__dict__[name]
 
     def _open_tars(self):
         """Open all content tars from the whole hierarchy."""
         self.content_tars = dict()
         for path in self.content_tar_paths:
-            self.content_tars[path] = tarfile.open(path, 'r:*')
+            self.content_tars[path] = ArchiveReader(path, self.tar_indexes.get(path))
 
     def _close_tars(self):
         """Close all tars opened in _open_tars."""
@@ -68,7 +194,9 @@ class Asset:
 
     def _unpack_manifest(self):
         """Unpack the manifest."""
-        with self.content_tars[self.files['manifest.mp']].extractfile('manifest.mp') as manifest:
+        path = self.files['manifest.mp']
+        with ArchiveReader(path, self.tar_indexes.get(path)) as archive, \
+                archive.extractfile('manifest.mp') as manifest:
             self.manifest = msgpack.unpackb(manifest.read(), encoding='utf-8')
 
     def __hash__(self):
@@ -78,21 +206,10 @@ class Asset:
 class Character(Asset):
     category = 'character'
 
-    def load(self):
-        try:
-            self._open_tars()
-            self._unpack_manifest()
-
-            # Parse the important parts of the manifest
-            try:
-                self.parse_animations()
-                self.parse_emotes()
-                self.parse_preanims()
-            except KeyError:
-                raise MissingEntryError()
-        finally:
-            self._close_tars()
-
+    lazy_attributes = dict(Asset.lazy_attributes,
+                           animations='parse_animations',
+                           emotes='parse_emotes',
+                           preanims='parse_preanims')
 
     def parse_animations(self):
         """Parse animations."""
@@ -130,18 +247,9 @@ class Character(Asset):
 class Background(Asset):
     category = 'background'
 
-    def load(self):
-        try:
-            self._open_tars()
-            self._unpack_manifest()
-
-            try:
-                self.parse_sides()
-                self.parse_overlays()
-            except KeyError:
-                raise MissingEntryError()
-        finally:
-            self._close_tars()
+    lazy_attributes = dict(Asset.lazy_attributes,
+                           sides='parse_sides',
+                           overlays='parse_overlays')
 
     def parse_overlays(self):
         self.overlays = []
@@ -163,33 +271,22 @@ class Background(Asset):
 class Audio(Asset):
     category = 'audio'
 
-    def load(self):
-        try:
-            self._open_tars()
-            self._unpack_manifest()
+    lazy_attributes = dict(Asset.lazy_attributes,
+                           filename='parse_audio',
+                           length='parse_audio')
 
-            try:
-                self.filename = self.manifest['filename']
-                self.length = self.manifest['length']
-            except KeyError:
-                raise MissingEntryError()
-        finally:
-            self._close_tars()
+    def parse_audio(self):
+        self.filename = self.manifest['filename']
+        self.length = self.manifest['length']
 
 class Evidence(Asset):
     category = 'ao3/evidence'
 
-    def load(self):
-        try:
-            self._open_tars()
-            self._unpack_manifest()
-
-            try:
-                self.images = self.manifest['images']
-            except KeyError:
-                raise MissingEntryError()
-        finally:
-            self._close_tars()
+    lazy_attributes = dict(Asset.lazy_attributes,
+                           images='parse_images')
+
+    def parse_images(self):
+        self.images = self.manifest['images']
 
 class Animation:
     """
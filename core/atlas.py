@@ -0,0 +1,117 @@
+from pyglet.image.atlas import AllocatorException, TextureAtlas, get_max_texture_size
+
+from . import profiler
+
+
+class AtlasPage:
+    """
+    atlas:
+        The pyglet texture atlas
+    used:
+        Area still occupied by live animations
+    owners:
+        Keys of the animations with frames on this page
+    """
+    __slots__ = \
+        'atlas', \
+        'used', \
+        'owners'
+
+
+class AtlasManager:
+    """
+    Packs the frames of every animation loaded into a GL context into a
+    small number of large shared textures ("pages"), so a frame showing
+    many characters binds few textures.
+
+    pyglet's allocator cannot free space, so pages are reclaimed whole:
+    a page is dropped once none of its animations are left, and
+    `defragment` repacks pages that are mostly dead space.
+    """
+
+    def __init__(self, texture_width: int = 2048, texture_height: int = 2048):
+        """Must be created while the GL context it serves is current."""
+        max_texture_size = get_max_texture_size()
+        self.texture_width = min(texture_width, max_texture_size)
+        self.texture_height = min(texture_height, max_texture_size)
+        self.pages = []
+        # Maps keys to (animation, {page: area used by the animation})
+        self._animations = dict()
+
+    def add(self, key, anim):
+        """
+        Upload an animation's frames, replacing them in place with regions
+        of the shared pages.
+        """
+        self.release(key)
+        usage = dict()
+        for frame in anim.frames:
+            frame.image = self._upload(frame.image, usage)
+        for page in usage:
+            page.owners.add(key)
+        self._animations[key] = anim, usage
+
+    def release(self, key):
+        """
+        Forget an animation. Its space is reclaimed when its page is dropped
+        or repacked; the textures are freed once no sprite refers to them.
+        """
+        _, usage = self._animations.pop(key, (None, {}))
+        for page, area in usage.items():
+            page.used -= area
+            page.owners.discard(key)
+            if not page.owners:
+                self.pages.remove(page)
+
+    def defragment(self, threshold: float = 0.5):
+        """
+        Repack every page whose live area is below `threshold` of the area
+        allocated in it. Sprites showing a moved frame keep using the old
+        texture until their next frame.
+        """
+        sparse = [page for page in self.pages
+                  if page.used < threshold * page.atlas.allocator.used_area]
+        for page in sparse:
+            self.pages.remove(page)
+        for page in sparse:
+            # Read the whole page back once rather than once per frame.
+            data = page.atlas.texture.get_image_data()
+            for key in page.owners:
+                anim, usage = self._animations[key]
+                del usage[page]
+                for frame in anim.frames:
+                    region = frame.image
+                    if getattr(region, 'owner', None) is page.atlas.texture:
+                        frame.image = self._upload(
+                            data.get_region(region.x, region.y, region.width, region.height), usage)
+                for new_page in usage:
+                    new_page.owners.add(key)
+
+    def _upload(self, img, usage: dict):
+        with profiler.section('upload'):
+            return self._allocate(img, usage)
+
+    def _allocate(self, img, usage: dict):
+        if img.width > self.texture_width or img.height > self.texture_height:
+            # Too big to share a page with anything
+            return img.get_texture()
+        for page in self.pages:
+            try:
+                region = page.atlas.add(img)
+                break
+            except AllocatorException:
+                pass
+        else:
+            page = AtlasPage()
+            page.atlas = TextureAtlas(self.texture_width, self.texture_height)
+            page.used = 0
+            page.owners = set()
+            self.pages.append(page)
+            region = page.atlas.add(img)
+        area = img.width * img.height
+        page.used += area
+        usage[page] = usage.get(page, 0) + area
+        return region
+
+    def __len__(self):
+        return len(self.pages)
@@ -0,0 +1,87 @@
+"""
+Persistent records about content tars, kept under `assets/.cache`.
+
+Each tar gets its own small record file so that verifying one asset never
+rewrites the records of every other installed asset.
+"""
+import hashlib
+import logging
+import os
+
+import msgpack
+
+cache_logger = logging.getLogger("ac.core.cache")
+
+
+class VerificationCache:
+
+    def __init__(self, root: str = None):
+        """
+        Open the cache stored in `root`, which defaults to `assets/.cache`
+        under the working directory. The directory is created lazily.
+        """
+        self.root = root or os.path.join(os.getcwd(), 'assets', '.cache')
+
+    @staticmethod
+    def identity(path: str) -> list:
+        """
+        Get the identity of a file: size, modification time and inode.
+        Take this before hashing so that a write racing the hash shows
+        up as a mismatch on the next lookup.
+        """
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def _record_path(self, path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, name + '.mp')
+
+    def _load(self, path: str):
+        try:
+            with open(self._record_path(path), 'rb') as f:
+                record = msgpack.unpackb(f.read(), encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            cache_logger.warning("Discarding unreadable cache record for %s: %s", path, e)
+            return None
+        if not isinstance(record, dict) or record.get('path') != os.path.abspath(path):
+            return None
+        return record
+
+    def lookup(self, path: str, identity: list, digest: bytes):
+        """
+        Get the member index and compression flag of `path` if it was last
+        verified against `digest` and has not changed since.
+        Returns None if the record is missing or stale.
+        """
+        record = self._load(path)
+        if record is None \
+                or record.get('identity') != identity \
+                or record.get('hash') != digest \
+                or 'index' not in record:
+            return None
+        return record['index'], record.get('compressed', True)
+
+    def store(self, path: str, identity: list, digest: bytes, index: dict, compressed: bool):
+        """
+        Record a successful verification of `path` along with its member
+        index (name to offset and size in the uncompressed stream).
+        """
+        record = {
+            'path': os.path.abspath(path),
+            'identity': identity,
+            'hash': digest,
+            'index': index,
+            'compressed': compressed
+        }
+        record_path = self._record_path(path)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            # Write then rename so a crash never leaves a half-written record.
+            with open(record_path + '.tmp', 'wb') as f:
+                f.write(msgpack.packb(record, use_bin_type=True))
+            os.replace(record_path + '.tmp', record_path)
+        except OSError as e:
+            # A read-only install still works, it just hashes every time.
+            cache_logger.warning("Could not write cache record for %s: %s", path, e)
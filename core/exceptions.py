@@ -15,4 +15,10 @@ class MissingEntryError(AssetError):
     """
     Raised when a entry in a manifest was expected but not found.
     """
-    pass
\ No newline at end of file
+    pass
+
+class CyclicParentError(AssetError):
+    """
+    Raised when an asset is (indirectly) its own parent.
+    """
+    pass
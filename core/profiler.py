@@ -0,0 +1,94 @@
+"""
+Frame-time instrumentation for the renderer.
+
+A frame is everything timed since the previous frame was presented:
+updates, scene drawing, texture uploads and the buffer swap.
+"""
+import csv
+import json
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+# Sections reported in summaries and exports, in order.
+SECTIONS = ('update', 'draw', 'upload', 'swap', 'total')
+
+# Sections that happen inside other sections, left out of the total.
+NESTED = ('upload',)
+
+# The profiler of the widget that is currently updating or drawing.
+_active = None
+
+
+def section(name: str):
+    """Time a section of the active profiler's current frame, if there is one."""
+    if _active is None:
+        return nullcontext()
+    return _active.section(name)
+
+
+class FrameProfiler:
+
+    def __init__(self, window: int = 600):
+        """Keep the timings of the last `window` frames."""
+        self.frames = deque(maxlen=window)
+        self.frame_count = 0
+        self._current = dict()
+
+    def make_current(self):
+        """Make this the profiler that `section` reports to."""
+        global _active
+        _active = self
+
+    @contextmanager
+    def section(self, name: str):
+        """Add the time spent in the block to `name` in the current frame."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[name] = self._current.get(name, 0.0) + time.perf_counter() - start
+
+    def end_frame(self):
+        """Close the current frame. Call this after presenting it."""
+        frame = self._current
+        frame['total'] = sum(value for name, value in frame.items() if name not in NESTED)
+        self.frames.append(frame)
+        self.frame_count += 1
+        self._current = dict()
+
+    def percentiles(self, name: str, points=(50, 95, 99)) -> list:
+        """Get percentiles (nearest rank) of a section over the window, in seconds."""
+        samples = sorted(frame.get(name, 0.0) for frame in self.frames)
+        if not samples:
+            return [0.0 for _ in points]
+        return [samples[min(len(samples) - 1, max(0, -(-point * len(samples) // 100) - 1))]
+                for point in points]
+
+    def summary(self) -> str:
+        """Format p50/p95/p99 of every section in milliseconds, one per line."""
+        lines = []
+        for name in SECTIONS:
+            p50, p95, p99 = (value * 1000 for value in self.percentiles(name))
+            lines.append('{:<6} p50 {:6.2f}  p95 {:6.2f}  p99 {:6.2f} ms'.format(name, p50, p95, p99))
+        return '\n'.join(lines)
+
+    def export_json(self, path: str):
+        """Write the frames in the window and their percentiles (seconds)."""
+        first = self.frame_count - len(self.frames)
+        trace = {
+            'frames': [dict(frame, frame=first + i) for i, frame in enumerate(self.frames)],
+            'percentiles': {name: dict(zip(('p50', 'p95', 'p99'), self.percentiles(name)))
+                            for name in SECTIONS}
+        }
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent=2)
+
+    def export_csv(self, path: str):
+        """Write one row per frame in the window (seconds)."""
+        first = self.frame_count - len(self.frames)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('frame',) + SECTIONS)
+            for i, frame in enumerate(self.frames):
+                writer.writerow((first + i,) + tuple(frame.get(name, 0.0) for name in SECTIONS))
@@ -1,21 +1,178 @@
+import weakref
+from collections import OrderedDict
+
+from .archive import ArchiveReader
 from .asset import Animation
+from .atlas import AtlasManager
 import pyglet
+import pyglet.gl
 import pyglet.sprite
-import tarfile
 
 
-def load_animation(animation: Animation, archive: tarfile.TarFile) -> pyglet.sprite.Sprite:
+class CachedAnimation:
+    """
+    animation:
+        The decoded pyglet animation
+    cpu_bytes:
+        Frame memory still held in main memory
+    gpu_bytes:
+        Frame memory uploaded to textures
+    pins:
+        Number of outstanding pins; pinned entries are never evicted
+    """
+    __slots__ = \
+        'animation', \
+        'cpu_bytes', \
+        'gpu_bytes', \
+        'pins'
+
+
+class AnimationCache:
+    """
+    Least-recently-used cache of decoded animations, keyed by
+    `(archive path, member name)`.
+
+    Texture memory and main memory are budgeted separately. When either
+    budget is exceeded, the least recently used unpinned animations are
+    dropped until both fit again. Pin the animations that are on screen.
+
+    If an atlas manager is given, animations put into the cache are
+    uploaded into it, and released from it when evicted.
+    """
+
+    def __init__(self, gpu_budget: int = 256 * 1024 * 1024, cpu_budget: int = 64 * 1024 * 1024,
+                 atlas: AtlasManager = None):
+        self.atlas = atlas
+        self.gpu_budget = gpu_budget
+        self.cpu_budget = cpu_budget
+        self.gpu_bytes = 0
+        self.cpu_bytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def measure(anim: pyglet.image.Animation):
+        """Estimate the main memory and texture memory used by an animation's frames."""
+        cpu_bytes = gpu_bytes = 0
+        for frame in anim.frames:
+            size = frame.image.width * frame.image.height * 4
+            if isinstance(frame.image, pyglet.image.Texture):
+                gpu_bytes += size
+            else:
+                cpu_bytes += size
+        return cpu_bytes, gpu_bytes
+
+    def get(self, key):
+        """Get a cached animation and mark it as recently used, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry.animation
+
+    def put(self, key, anim: pyglet.image.Animation, pin: bool = False):
+        """
+        Add an animation, pinned if `pin` is set, evicting others if the
+        budgets are exceeded.
+        """
+        self.evict(key)
+        if self.atlas is not None:
+            self.atlas.add(key, anim)
+        entry = CachedAnimation()
+        entry.animation = anim
+        entry.cpu_bytes, entry.gpu_bytes = self.measure(anim)
+        entry.pins = 1 if pin else 0
+        self._entries[key] = entry
+        self.cpu_bytes += entry.cpu_bytes
+        self.gpu_bytes += entry.gpu_bytes
+        self._shrink()
+
+    def evict(self, key):
+        """Drop an animation from the cache, pinned or not."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.cpu_bytes -= entry.cpu_bytes
+            self.gpu_bytes -= entry.gpu_bytes
+            if self.atlas is not None:
+                self.atlas.release(key)
+
+    def pin(self, key):
+        """Keep an animation in the cache until it is unpinned."""
+        self._entries[key].pins += 1
+
+    def unpin(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.pins > 0:
+            entry.pins -= 1
+            self._shrink()
+
+    def clear(self):
+        """
+        Drop every unpinned animation (e.g. when characters leave) and
+        repack the atlas pages they leave mostly empty.
+        """
+        for key in [key for key, entry in self._entries.items() if entry.pins == 0]:
+            self.evict(key)
+        if self.atlas is not None:
+            self.atlas.defragment()
+
+    def _shrink(self):
+        if self.gpu_bytes <= self.gpu_budget and self.cpu_bytes <= self.cpu_budget:
+            return
+        for key in [key for key, entry in self._entries.items() if entry.pins == 0]:
+            self.evict(key)
+            if self.gpu_bytes <= self.gpu_budget and self.cpu_bytes <= self.cpu_budget:
+                break
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Textures cannot be shared between GL contexts, so each context gets
+# its own cache and atlas.
+_caches = weakref.WeakKeyDictionary()
+
+
+def animation_cache() -> AnimationCache:
+    """Get the animation cache of the current GL context."""
+    context = pyglet.gl.current_context
+    cache = _caches.get(context)
+    if cache is None:
+        cache = _caches[context] = AnimationCache(atlas=AtlasManager())
+    return cache
+
+
+def animation_key(animation: Animation, archive: ArchiveReader):
+    """Get the key `animation` is cached under."""
+    return archive.path if archive is not None else None, animation.filename
+
+
+def load_animation(animation: Animation, archive: ArchiveReader, pin: bool = False) -> pyglet.sprite.Sprite:
     """
     Loads an animation to a Pyglet sprite.
-    `archive` may refer to a tar file which the animation may be located in.
+    `archive` may refer to an archive which the animation may be located in.
     If this is not the case, then the animation's filename will be used as
-    an absolute path."""
-    filename = animation.filename
-    if archive is not None:
-        with archive.extractfile(filename) as f:
-            anim = pyglet.image.load_animation(filename, file=f)
+    an absolute path.
+
+    Decoded animations are kept in the current context's
+    `animation_cache()` and their frames are packed into its shared
+    atlas, so loading the same animation again only creates a new sprite.
+    If `pin` is set, the animation stays cached until `unpin` is called
+    on the cache with its `animation_key`."""
+    cache = animation_cache()
+    key = animation_key(animation, archive)
+    anim = cache.get(key)
+    if anim is not None:
+        if pin:
+            cache.pin(key)
     else:
-        anim = pyglet.image.load_animation(filename)
-    tex_bin = pyglet.image.atlas.TextureBin()
-    anim.add_to_texture_bin(tex_bin)
-    return pyglet.sprite.Sprite(anim)
\ No newline at end of file
+        filename = animation.filename
+        if archive is not None:
+            with archive.extractfile(filename) as f:
+                anim = pyglet.image.load_animation(filename, file=f)
+        else:
+            anim = pyglet.image.load_animation(filename)
+        cache.put(key, anim, pin)
+    return pyglet.sprite.Sprite(anim)
@@ -0,0 +1,121 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from .exceptions import CyclicParentError
+
+
+class AssetRegistry:
+    """
+    Memoizes assets by `(category, id)`, so that a parent shared by many
+    assets is read and verified only once and its file map is shared by
+    all of its children.
+
+    The registry may be used from several threads at once: an asset that
+    is being loaded by one thread is waited on by the others instead of
+    being loaded twice.
+    """
+
+    def __init__(self, paranoid: bool = False):
+        """`paranoid` is passed on to every asset loaded through the registry."""
+        self.paranoid = paranoid
+        # Maps keys to assets, or to futures of assets still being loaded
+        self._assets = dict()
+        self._lock = threading.Lock()
+        # Keys of the assets whose manifests have actually been used
+        self._touched = set()
+
+    def get(self, cls, id: str):
+        """Get the asset of type `cls` by ID, loading it if necessary."""
+        key = (cls.category, id)
+        with self._lock:
+            entry = self._assets.get(key)
+            if entry is None:
+                entry = self._assets[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not isinstance(entry, Future):
+            return entry
+        if not owner:
+            return entry.result()
+
+        try:
+            # Walk the parent chain before loading anything. Since no cycle
+            # can get past this, threads waiting on each other's parents can
+            # never deadlock.
+            self._check_parents(cls, id)
+            asset = cls(id, self.paranoid, registry=self)
+        except BaseException as e:
+            with self._lock:
+                del self._assets[key]
+            entry.set_exception(e)
+            raise
+        with self._lock:
+            self._assets[key] = asset
+        entry.set_result(asset)
+        return asset
+
+    def touch(self, asset):
+        """Called by an asset the first time one of its lazy attributes is parsed."""
+        self._touched.add((asset.category, asset.id))
+
+    def metrics(self) -> dict:
+        """
+        Count the assets loaded through the registry (`registered`) and
+        how many of those were actually used (`touched`).
+        """
+        return {
+            'registered': len(self),
+            'touched': len(self._touched)
+        }
+
+    def _check_parents(self, cls, id: str):
+        chain = [id]
+        info = cls.read_info(id)
+        while 'parent' in info:
+            parent = info['parent']
+            if parent in chain:
+                raise CyclicParentError("Cyclic parents: {}".format(
+                    " -> ".join(chain[chain.index(parent):] + [parent])))
+            if not isinstance(self._assets.get((cls.category, parent), Future()), Future):
+                # Already loaded, so the rest of the chain is known to be fine
+                return
+            chain.append(parent)
+            info = cls.read_info(parent)
+
+    def __contains__(self, key):
+        return not isinstance(self._assets.get(key, Future()), Future)
+
+    def __len__(self):
+        return sum(not isinstance(entry, Future) for entry in list(self._assets.values()))
+
+
+def load_assets(ids, asset_type, registry: AssetRegistry = None,
+                executor=None, progress=None):
+    """
+    Load many assets of one type concurrently.
+
+    Verification is spread over a thread pool (hashlib releases the GIL
+    while hashing, and most of the rest is I/O). Process pools are not
+    supported, since assets share parents through the registry.
+
+    Yields `(id, future)` pairs in the order the loads complete; calling
+    `future.result()` gives the asset or raises the error that prevented
+    it from loading. `progress`, if given, is called with
+    `(completed, total)` after each load, from the consuming thread.
+    """
+    if registry is None:
+        registry = AssetRegistry()
+    ids = list(ids)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    try:
+        futures = {executor.submit(registry.get, asset_type, id): id for id in ids}
+        for completed, future in enumerate(as_completed(futures), 1):
+            if progress is not None:
+                progress(completed, len(ids))
+            yield futures[future], future
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
@@ -1,6 +1,111 @@
 from collections import deque, OrderedDict
+from pyglet.graphics import Batch, OrderedGroup
+from pyglet.image import SolidColorImagePattern
+from pyglet.media import Player, SourceGroup
 from pyglet.sprite import Sprite
 
+from .timeline import Timeline
+
+# Seconds between two characters of a chat message appearing.
+TEXT_TICK = 0.04
+
+# Seconds between two steps of a fade.
+FADE_STEP = 1 / 60
+
+# SetBackground.Transition.TransitionType values (see network.packets)
+TRANSITION_NONE = 0
+TRANSITION_FADE_TO_BLACK = 1
+TRANSITION_CROSSFADE = 2
+TRANSITION_FADE_TO_WHITE = 3
+
+
+class Layers(OrderedDict):
+    """
+    The layers of a scene by name, drawn from bottom to top.
+
+    Sprites put in here are moved into the scene's batch, in a group
+    ordered by the layer's position, so that drawing every sprite layer is
+    a single batch draw. Any other layer is drawn on its own, after the
+    batch. Inserting, replacing, removing and reordering layers keeps the
+    groups in sync.
+
+    `on_remove(layer)`, if set, is called with every layer that was
+    replaced or removed and is no longer shown under any name.
+    """
+
+    def __init__(self, batch: Batch):
+        super().__init__()
+        self.batch = batch
+        self.on_remove = None
+
+    def __setitem__(self, name, layer):
+        old = self[name] if name in self else None
+        super().__setitem__(name, layer)
+        self._reorder()
+        if old is not None:
+            self._removed(old)
+
+    def __delitem__(self, name):
+        layer = self[name]
+        super().__delitem__(name)
+        self._reorder()
+        self._removed(layer)
+
+    def pop(self, name, *default):
+        present = name in self
+        layer = super().pop(name, *default)
+        self._reorder()
+        if present:
+            self._removed(layer)
+        return layer
+
+    def popitem(self, last=True):
+        name, layer = super().popitem(last)
+        self._reorder()
+        self._removed(layer)
+        return name, layer
+
+    def clear(self):
+        layers = list(self.values())
+        super().clear()
+        for layer in layers:
+            self._removed(layer)
+
+    def move_to_end(self, name, last=True):
+        super().move_to_end(name, last)
+        self._reorder()
+
+    def insert_after(self, existing, name, layer):
+        """Add a layer directly above the layer named `existing`."""
+        names = list(self)
+        above = names[names.index(existing) + 1:]
+        self[name] = layer
+        for other in above:
+            if other != name:
+                self.move_to_end(other)
+
+    def _reorder(self):
+        # The setters do nothing for layers whose position is unchanged.
+        for order, layer in enumerate(self.values()):
+            if isinstance(layer, Sprite):
+                layer.group = OrderedGroup(order)
+                layer.batch = self.batch
+
+    def _removed(self, layer):
+        # A layer may be moved to another name by adding it there first
+        if any(other is layer for other in self.values()):
+            return
+        self._unbatch(layer)
+        if self.on_remove is not None:
+            self.on_remove(layer)
+
+    @staticmethod
+    def _unbatch(layer):
+        if isinstance(layer, Sprite):
+            layer.batch = None
+            layer.group = None
+
+
 class Scene:
 
     def __init__(self):
@@ -8,10 +113,180 @@ class Scene:
         Initializes a scene.
         """
         self.action_queue = deque()
+        # Consumes the action queue; may be scheduled on from any thread
+        self.timeline = Timeline(self.action_queue)
+        self.batch = Batch()
         # Layers are drawn from bottom to top.
         # String defines a name for the layer (e.g. `background`).
-        self.layers = OrderedDict()
+        self.layers = Layers(self.batch)
+        # Maps layer names to the chat message currently playing on them
+        self._playing = dict()
+        # Maps layer names to the background last set on them
+        self._backgrounds = dict()
+        # Maps sound channels to the player playing on them
+        self.channels = dict()
+
+    def update(self):
+        """Run the actions that are due. Call this once per frame."""
+        return self.timeline.advance()
+
+    def play_chat(self, emote, text: str, load, on_text=None, layer: str = 'character', tick: float = TEXT_TICK):
+        """
+        Play a chat message on a layer: the emote's preanimation if it has
+        one, its talking animation while `text` appears one character per
+        `tick`, its postanimation if it has one, then its idle animation.
+        A newer message on the same layer cuts this one short.
+
+        `load(animation)` must return a sprite for an `core.asset.Animation`,
+        or None if it cannot be shown, and `on_text(shown)` is called with
+        the text shown so far.
+        """
+        timeline = self.timeline
+        token = self._playing[layer] = object()
+
+        def show(animation) -> float:
+            sprite = load(animation)
+            if sprite is None:
+                # Carry on with the rest of the message
+                return 0
+            self.layers[layer] = sprite
+            image = sprite.image
+            return image.get_duration() if hasattr(image, 'get_duration') else 0
+
+        def step(callback):
+            # Drop the steps of messages that were superseded
+            def run(*args):
+                if self._playing.get(layer) is token:
+                    callback(*args)
+            return run
+
+        @step
+        def preanim():
+            animation = getattr(emote, 'talking_preanim', None)
+            timeline.schedule(show(animation) if animation is not None else 0, talking)
+
+        @step
+        def talking():
+            show(emote.talking)
+            type_text(1)
+
+        @step
+        def type_text(shown: int):
+            if on_text is not None:
+                on_text(text[:shown])
+            if shown < len(text):
+                timeline.schedule(tick, type_text, shown + 1)
+            else:
+                timeline.schedule(tick, postanim)
+
+        @step
+        def postanim():
+            animation = getattr(emote, 'talking_postanim', None)
+            timeline.schedule(show(animation) if animation is not None else 0, idle)
+
+        @step
+        def idle():
+            show(emote.idle)
+            del self._playing[layer]
+
+        return timeline.schedule(0, preanim)
+
+    def set_background(self, sprite: Sprite, transition_type: int = TRANSITION_NONE,
+                       duration: float = 0, layer: str = 'background'):
+        """
+        Replace the background, optionally through one of the transitions
+        of `SetBackground.Transition` lasting `duration` seconds. A newer
+        background on the same layer cuts the transition short.
+        """
+        token = self._backgrounds[layer] = object()
+        transition_layer = layer + '_transition'
+
+        def current() -> bool:
+            return self._backgrounds.get(layer) is token
+
+        def step(callback):
+            # Drop the steps of backgrounds that were superseded
+            def run(*args):
+                if current():
+                    callback(*args)
+            return run
+
+        @step
+        def start():
+            # Whatever a transition cut short left on screen
+            self.layers.pop(transition_layer, None)
+            old = self.layers.get(layer)
+            if old is None or transition_type == TRANSITION_NONE or duration <= 0:
+                self.layers[layer] = sprite
+            elif transition_type == TRANSITION_CROSSFADE:
+                sprite.opacity = 0
+                self.layers.insert_after(layer, transition_layer, sprite)
+                self._fade(sprite, 0, 255, duration, finish_crossfade, current)
+            else:
+                color = (255, 255, 255, 255) if transition_type == TRANSITION_FADE_TO_WHITE \
+                    else (0, 0, 0, 255)
+                overlay = Sprite(SolidColorImagePattern(color).create_image(
+                    max(old.width, sprite.width), max(old.height, sprite.height)))
+                overlay.opacity = 0
+                self.layers.insert_after(layer, transition_layer, overlay)
+                self._fade(overlay, 0, 255, duration / 2, lambda: swap_under(overlay), current)
+
+        @step
+        def finish_crossfade():
+            self.layers[layer] = sprite
+            del self.layers[transition_layer]
+
+        @step
+        def swap_under(overlay):
+            self.layers[layer] = sprite
+            self._fade(overlay, 255, 0, duration / 2, step(lambda: self.layers.pop(transition_layer, None)),
+                       current)
+
+        return self.timeline.schedule(0, start)
+
+    def play_sound(self, source, channel: int = 0, loop: bool = False):
+        """
+        Play a `pyglet.media.Source` on a channel, in place of whatever the
+        channel was playing. With `loop`, it plays until it is stopped.
+        """
+        def start():
+            self._stop_sound(channel)
+            group = SourceGroup(source.audio_format, None)
+            group.loop = loop
+            group.queue(source)
+            player = self.channels[channel] = Player()
+            player.queue(group)
+            player.play()
+
+        return self.timeline.schedule(0, start)
+
+    def stop_sound(self, channel: int = 0):
+        return self.timeline.schedule(0, self._stop_sound, channel)
+
+    def _stop_sound(self, channel: int):
+        player = self.channels.pop(channel, None)
+        if player is not None:
+            player.delete()
+
+    def _fade(self, sprite: Sprite, start_opacity: int, end_opacity: int, duration: float, then=None,
+              alive=None):
+        """Fade a sprite, then call `then()`. Stops as soon as `alive()` is false."""
+        start = self.timeline.now
+
+        def step():
+            if alive is not None and not alive():
+                return
+            progress = min(1.0, (self.timeline.now - start) / duration) if duration > 0 else 1.0
+            sprite.opacity = int(start_opacity + (end_opacity - start_opacity) * progress)
+            if progress < 1.0:
+                self.timeline.schedule(FADE_STEP, step)
+            elif then is not None:
+                then()
+
+        step()
 
     def draw(self):
+        self.batch.draw()
         for name, layer in self.layers.items():
-            layer.draw()
\ No newline at end of file
+            if not isinstance(layer, Sprite):
+                layer.draw()
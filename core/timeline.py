@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+
+class Action:
+    """
+    time:
+        When the action is due, on the timeline's clock
+    callback:
+        Called with `args` when the action is due
+    args:
+        Arguments for the callback
+    cancelled:
+        Whether the action was cancelled before it ran
+    """
+    __slots__ = \
+        'time', \
+        'callback', \
+        'args', \
+        'cancelled'
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timeline:
+    """
+    Runs actions at exact times on a monotonic clock.
+
+    Actions may be scheduled from any thread: they are appended to
+    `inbox` (appending to a deque is atomic) and moved into a heap by the
+    thread that calls `advance`, normally once per frame. Only due actions
+    are ever looked at, no matter how many are pending.
+
+    While an action runs, `now` is the time it was due rather than the
+    time it actually ran, so chains of actions scheduled from callbacks do
+    not drift with frame timing.
+    """
+
+    def __init__(self, inbox: deque = None, clock=time.monotonic, wakeup=None):
+        """
+        `wakeup`, if given, is called (on the scheduling thread) whenever an
+        action is scheduled, so an idle consumer knows to advance again.
+        """
+        self.inbox = inbox if inbox is not None else deque()
+        self.clock = clock
+        self.wakeup = wakeup
+        self._heap = []
+        # Breaks ties between actions due at the same time: first come, first run
+        self._counter = itertools.count()
+        # Holds the due time of the running action, on the advancing thread only
+        self._running = threading.local()
+
+    @property
+    def now(self) -> float:
+        current_time = getattr(self._running, 'time', None)
+        if current_time is not None:
+            return current_time
+        return self.clock()
+
+    def schedule(self, delay: float, callback, *args) -> Action:
+        """Run `callback(*args)` `delay` seconds from now."""
+        return self.schedule_at(self.now + delay, callback, *args)
+
+    def schedule_at(self, when: float, callback, *args) -> Action:
+        """Run `callback(*args)` at time `when` on the timeline's clock."""
+        action = Action()
+        action.time = when
+        action.callback = callback
+        action.args = args
+        action.cancelled = False
+        self.inbox.append(action)
+        if self.wakeup is not None:
+            self.wakeup()
+        return action
+
+    def advance(self, now: float = None) -> int:
+        """
+        Run every action due by `now` (defaults to the clock), in the
+        order they are due. Returns how many actions ran.
+        """
+        if now is None:
+            now = self.clock()
+        self._drain()
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, _, action = heapq.heappop(self._heap)
+            if action.cancelled:
+                continue
+            self._running.time = action.time
+            try:
+                action.callback(*action.args)
+            finally:
+                self._running.time = None
+            ran += 1
+            # Pick up actions scheduled by the callback, which may be due already
+            self._drain()
+        return ran
+
+    def next_deadline(self):
+        """
+        Get the time the next pending action is due, or None.
+        Only call this from the thread that advances the timeline.
+        """
+        self._drain()
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def clear(self):
+        """Drop every pending action."""
+        self.inbox.clear()
+        self._heap.clear()
+
+    def _drain(self):
+        while self.inbox:
+            action = self.inbox.popleft()
+            heapq.heappush(self._heap, (action.time, next(self._counter), action))
+
+    def __len__(self):
+        return len(self._heap) + len(self.inbox)
@@ -2,15 +2,24 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from typing import Type
 
-import msgpack
-import struct
 import hashlib
+import itertools
 import logging
-from network import packets
+from network import codec, packets
+from network.exceptions import ProtocolError, RequestRejected
 from network.unique import unique_id
 
 client_logger = logging.getLogger("ac.net.client")
 
+# Seconds to wait for a response before a request fails
+REQUEST_TIMEOUT = 10
+
+# Packets a server also sends unrequested. A response of one of these
+# types can only be told apart by its sequence number.
+UNSOLICITED = frozenset(packet.msgid for packet in (
+    packets.Chat, packets.ChatOOC, packets.Join, packets.Leave, packets.Disconnect,
+    packets.SetBackground, packets.SoundPlay, packets.SoundStop, packets.SoundVolume))
+
 class ClientHandler:
 
     def __init__(self, client):
@@ -37,10 +46,14 @@ class ClientHandler:
 
 class Client:
 
-    def __init__(self, address, port='42505', master=True, thread=None):
+    def __init__(self, address, port='42505', master=True, thread=None, limits: dict = None):
         self.address = address
         self.port = port
 
+        # Size limits on what the server may send, in place of the defaults
+        # (see `codec.MessageDecoder`).
+        self.limits = limits or dict()
+
         # Whether or not this client is subscribed to events.
         self.master = master
 
@@ -77,7 +90,8 @@ class Client:
         except OSError as e:
             client_logger.warning("Failed to establish connection:")
             client_logger.warning("%s", str(e))
-            disconnect_future.cancel()
+            if disconnect_future is not None:
+                disconnect_future.cancel()
             raise
         client_logger.info("Established connection to %s:%d", self.address, self.port)
 
@@ -96,25 +110,47 @@ class Client:
     def write(self, msg: packets.Packet):
         self._protocol.write(msg)
 
+    async def drain(self):
+        """Wait until the server has caught up with what we wrote."""
+        await self._protocol.drain()
+
     def send_request(self, future: asyncio.Future,
-                     msg: packets.Packet, expected_response: Type[packets.Packet]):
-        self._protocol.send_request(future, msg, expected_response)
+                     msg: packets.Packet, expected_response: Type[packets.Packet],
+                     timeout: float = REQUEST_TIMEOUT):
+        self._protocol.send_request(future, msg, expected_response, timeout)
+
+    async def request(self, msg: packets.Packet, expected_response: Type[packets.Packet],
+                      timeout: float = REQUEST_TIMEOUT) -> dict:
+        """
+        Send a request and wait for its response. Raises asyncio.TimeoutError
+        if none arrives within `timeout` seconds (None waits forever).
+        """
+        future = asyncio.Future()
+        self.send_request(future, msg, expected_response, timeout)
+        await self.drain()
+        return await future
 
     def close(self):
         if self._transport is not None and not self._transport.is_closing():
             self.write(packets.Goodbye())
-            self._transport.close()
+            self._protocol.close()
         try:
             self.handler.handle_disconnect()
         except KeyError:
             pass
 
+    def accept_compression(self):
+        """Accept compressed packets from the server from now on."""
+        self._protocol.accept_compression()
+
     async def get_server_info(self):
-        future = asyncio.Future()
-        self.send_request(future,
-                          packets.ServerInfoRequest(packets.ServerInfoRequest.ServerInfoRequestType.FULL),
-                          packets.ServerInfoResponse)
-        result = await future
+        # The server may compress its response as soon as we offer to
+        self.accept_compression()
+        result = await self.request(packets.ServerInfoRequest(packets.ServerInfoRequest.ServerInfoRequestType.FULL,
+                                                              compression=[codec.COMPRESSION]),
+                                    packets.ServerInfoResponse)
+        if result.get('compression') == codec.COMPRESSION:
+            self._protocol.enable_compression()
         self.challenge = result['auth_challenge']
         return result
 
@@ -124,13 +160,12 @@ class Client:
         if password is not None:
             sha256.update(password.encode("utf-8"))
         sha256.update(self.challenge)
-        future = asyncio.Future()
         request = packets.JoinRequest(player_name=name,
                                       player_id=unique_id(),
                                       auth_response=sha256.digest(),
-                                      master=self.master)
-        self.send_request(future, request, packets.JoinResponse)
-        result = await future
+                                      master=self.master,
+                                      compression=codec.COMPRESSION if self._protocol.compression else None)
+        result = await self.request(request, packets.JoinResponse)
         # Parse response
         result_codes = packets.JoinResponse.JoinResult
         if result['result_code'] == result_codes.SUCCESS:
@@ -150,28 +185,24 @@ class Client:
         """
         Doesn't exist.
         """
-        future = asyncio.Future()
-        self.send_request(future, packets.RoomListRequest(), packets.RoomListResponse)
-        return await future
+        return await self.request(packets.RoomListRequest(), packets.RoomListResponse)
 
     async def join_room(self, room_id: int, password: str = None):
-        future = asyncio.Future()
         auth_response = None
         if password is not None:
             sha256 = hashlib.sha256()
             sha256.update(password.encode("utf-8"))
             sha256.update(self.challenge)
             auth_response = sha256.digest()
-        self.send_request(future, packets.JoinRoomRequest(room_id, auth_response), packets.JoinRoomResponse)
-        result = await future
+        result = await self.request(packets.JoinRoomRequest(room_id, auth_response), packets.JoinRoomResponse)
         self.current_room_id = room_id
         return result
 
     async def send_message(self, *, room_id: int, text: str, emote: str, preanimation: str = None):
-        future = asyncio.Future()
-        self.send_request(future, packets.Chat(room_id=room_id, text=text,
+        # Do not pile more messages onto a connection that is backed up
+        await self.drain()
+        return await self.request(packets.Chat(room_id=room_id, text=text,
                                                emote=emote, preanimation=preanimation), packets.Chat)
-        return await future
 
 
 class MockClientHandler(ClientHandler):
@@ -183,64 +214,133 @@ class ClientProtocol(asyncio.Protocol):
     def __init__(self, client, disconnect_future: asyncio.Future = None):
         super().__init__()
         self._client = client
-        self._buffer = None
-        # Maps packet IDs to futures
-        self._futures = dict()
+        self._decoder = codec.MessageDecoder(**client.limits)
+        # Maps request sequence numbers to (future, expected msgid, timeout handle)
+        self._pending = dict()
+        self._seq = itertools.count(1)
+        # Whether the server echoes sequence numbers, once known
+        self.echoes_seq = None
         self._disconnect_future = disconnect_future
 
     def write(self, message: packets.Packet):
-        if self.transport.is_closing():
-            raise ConnectionError("Connection is already closed")
-        self.transport.write(message.encode())
+        self._writer.write(message)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close(self):
+        self._writer.close()
+
+    @property
+    def compression(self) -> bool:
+        """Whether we compress large packets."""
+        return self._writer.compression
+
+    def accept_compression(self):
+        """Accept compressed packets from the server."""
+        self._decoder.compression = True
+
+    def enable_compression(self):
+        """Compress large packets from now on (the server agreed to it)."""
+        self._writer.compression = True
+
+    def pause_writing(self):
+        self._writer.pause_writing()
+
+    def resume_writing(self):
+        self._writer.resume_writing()
 
     def send_request(self, future: asyncio.Future,
-                     message: packets.Packet, expected_response: Type[packets.Packet]):
+                     message: packets.Packet, expected_response: Type[packets.Packet],
+                     timeout: float = REQUEST_TIMEOUT):
+        """
+        Send a request tagged with a new sequence number, and resolve
+        `future` with the response that echoes it. The request is
+        forgotten when the future is cancelled or times out.
+        """
+        seq = next(self._seq)
+        message.seq = seq
         self.write(message)
-        if expected_response.msgid not in self._futures:
-            self._futures[expected_response.msgid] = []
-        self._futures[expected_response.msgid].append(future)
+        handle = None
+        if timeout is not None:
+            handle = future.get_loop().call_later(timeout, self._expire, seq)
+        self._pending[seq] = (future, expected_response.msgid, handle)
+        future.add_done_callback(lambda _: self._forget(seq))
+
+    def _expire(self, seq: int):
+        future, msgid = self._forget(seq)
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError("No {} received in time".format(msgid)))
+
+    def _forget(self, seq: int):
+        """Stop tracking a request. Returns its future and expected msgid."""
+        future, msgid, handle = self._pending.pop(seq, (None, None, None))
+        if handle is not None:
+            handle.cancel()
+        return future, msgid
+
+    def _match(self, msg: dict):
+        """Find the sequence number of the request `msg` responds to, or None."""
+        seq = msg.get('seq')
+        if seq is not None:
+            self.echoes_seq = True
+            return seq if seq in self._pending else None
+        if self.echoes_seq is None and msg['id'] == packets.ServerInfoResponse.msgid:
+            # The first response of the handshake tells old servers apart
+            self.echoes_seq = False
+        if self.echoes_seq is not False or msg['id'] in UNSOLICITED:
+            return None
+        # A server that does not echo sequence numbers answers in order
+        for seq, (_, msgid, _) in self._pending.items():
+            if msgid == msg['id']:
+                return seq
+        return None
 
     def connection_made(self, transport: asyncio.Transport):
         self.transport = transport
+        self._writer = codec.FrameWriter(transport)
 
     def connection_lost(self, exc: Exception):
         client_logger.info("Connection lost: %s", exc)
-        for futures in self._futures.values():
-            for future in futures:
-                future.cancel()
+        self._writer.connection_lost(exc)
+        for future, _, _ in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
         if self._disconnect_future is not None:
             self._disconnect_future.set_result(exc)
 
     def data_received(self, data: bytes):
-        # Put it in a buffer and wait until it's filled
-        if self._buffer is not None:
-            self._buffer += data
-        else:
-            self._buffer = bytearray(data)
-        if len(self._buffer) == 0:
+        # Put it in a buffer and handle every message completed so far
+        # (there might be several messages wedged into one packet)
+        try:
+            messages = self._decoder.feed(data)
+        except ProtocolError as e:
+            client_logger.warning("Dropping connection: %s", e)
+            self.transport.close()
             return
-        msg_size = struct.unpack_from("<I", self._buffer)[0]
-        # First four bytes of a message contain the length (uint32 little-endian).
-        if len(self._buffer) >= msg_size + 4:
-            # Handle the packet
-            msg = msgpack.unpackb(self._buffer[4:msg_size + 4], encoding='utf-8')
-            client_logger.debug(msg)
-            try:
-                # Fulfill all futures that are waiting on this packet
-                if msg['id'] in self._futures:
-                    for future in self._futures[msg['id']]:
-                        future.set_result(msg)
-                    del self._futures[msg['id']]
-                # Call general message handler
-                loop = asyncio.get_event_loop()
-                loop.call_soon_threadsafe(self._client.handle_message, msg)
-            except KeyError:
-                client_logger.warn("Unknown packet!")
-            # Handle the other part of the packet (there might be two messages
-            # wedged into one packet)
-            remaining = self._buffer[msg_size + 4:]
-            self._buffer = None
-            self.data_received(remaining)
+        for msg in messages:
+            self._handle(msg)
+
+    def _handle(self, msg: dict):
+        client_logger.debug(msg)
+        try:
+            # Fulfill the request this packet responds to, if any
+            seq = self._match(msg)
+            if seq is not None:
+                future, msgid = self._forget(seq)
+                if future.done():
+                    pass
+                elif msg['id'] == msgid:
+                    future.set_result(msg)
+                elif msg['id'] == packets.Rejected.msgid:
+                    future.set_exception(RequestRejected(msg.get('reason_code'), msg.get('reason_msg')))
+                else:
+                    future.set_exception(ProtocolError("Expected {}, got {}".format(msgid, msg['id'])))
+            # Call general message handler
+            loop = asyncio.get_event_loop()
+            loop.call_soon_threadsafe(self._client.handle_message, msg)
+        except KeyError:
+            client_logger.warn("Unknown packet!")
 
 if __name__ == '__main__':
     #import binascii
@@ -0,0 +1,115 @@
+"""
+Server browser probe: pings many game servers at once from one event
+loop, and reports on each as soon as it answers (or fails to).
+"""
+import asyncio
+import logging
+
+from network import packets
+from network.client.client import Client, ClientHandler
+from network.exceptions import ProtocolError
+
+probe_logger = logging.getLogger("ac.net.client.probe")
+
+# Servers probed at once
+PROBE_CONCURRENCY = 64
+
+# Seconds a server has to accept the connection and answer
+PROBE_TIMEOUT = 5
+
+
+class ProbeResult:
+    """
+    address, port:
+        The server probed
+    rtt:
+        Seconds the server took to answer a ping, or None if the probe failed
+    info:
+        The server's basic ServerInfoResponse, if it was asked for
+    error:
+        Why the probe failed, if it did
+    """
+    __slots__ = \
+        'address', \
+        'port', \
+        'rtt', \
+        'info', \
+        'error'
+
+    def __init__(self, address: str, port: int):
+        self.address = address
+        self.port = port
+        self.rtt = None
+        self.info = None
+        self.error = None
+
+    @property
+    def key(self) -> str:
+        """The server's key in master server listings."""
+        return "{}:{}".format(self.address, self.port)
+
+    def __repr__(self):
+        return "ProbeResult({}, rtt={!r}, error={!r})".format(self.key, self.rtt, self.error)
+
+
+class Prober:
+    """
+    Pings servers: connects, sends a PING ServerInfoRequest and times the
+    answer, then (with `basic`) asks for the basic server info.
+    """
+
+    def __init__(self, concurrency: int = PROBE_CONCURRENCY, timeout: float = PROBE_TIMEOUT,
+                 basic: bool = False):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.basic = basic
+
+    async def probe_all(self, servers, on_result=None) -> list:
+        """
+        Probe every (address, port) in `servers`, at most `concurrency` at
+        a time. `on_result(result)` is called for each as soon as it is
+        done. Returns the results in the order they came in.
+        """
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(address, port):
+            async with limit:
+                return await self.probe(address, port)
+
+        tasks = [asyncio.ensure_future(bounded(address, port)) for address, port in servers]
+        results = []
+        try:
+            for future in asyncio.as_completed(tasks):
+                result = await future
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            # Stop what is left if we were cancelled
+            for task in tasks:
+                task.cancel()
+        return results
+
+    async def probe(self, address: str, port: int) -> ProbeResult:
+        result = ProbeResult(address, port)
+        client = Client(address, port, master=False)
+        client.handler = ClientHandler(client)
+        try:
+            await asyncio.wait_for(self._probe(client, result), self.timeout)
+        except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+            result.error = e
+        finally:
+            client.close()
+        probe_logger.debug("%r", result)
+        return result
+
+    async def _probe(self, client: Client, result: ProbeResult):
+        await client.connect()
+        request_types = packets.ServerInfoRequest.ServerInfoRequestType
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await client.request(packets.ServerInfoRequest(request_types.PING), packets.PingResponse, timeout=None)
+        result.rtt = loop.time() - start
+        if self.basic:
+            result.info = await client.request(packets.ServerInfoRequest(request_types.BASIC),
+                                               packets.ServerInfoResponse, timeout=None)
@@ -0,0 +1,243 @@
+"""
+Encoding and decoding of messages on the wire, shared by the client
+and the server: every message is a msgpack map, preceded by its size
+as a little-endian uint32 (see `network.framing`).
+
+Large messages may be compressed with zlib once both peers agreed on
+it: the client offers `COMPRESSION` in its ServerInfoRequest (or
+JoinRequest) and the server names it in its ServerInfoResponse.
+"""
+import asyncio
+import zlib
+
+import msgpack
+
+from network.exceptions import ProtocolError
+from network.framing import FrameDecoder, HEADER, FLAG_COMPRESSED
+
+# Limits on what a peer may send us. Anything larger is treated as
+# hostile rather than buffered.
+MAX_MESSAGE_SIZE = 1024 * 1024
+MAX_STR_LEN = 64 * 1024
+MAX_BIN_LEN = 512 * 1024
+MAX_ARRAY_LEN = 4096
+MAX_MAP_LEN = 256
+
+# The compression scheme we support, as named during negotiation
+COMPRESSION = 'zlib'
+
+# Payloads smaller than this are never worth compressing
+COMPRESS_THRESHOLD = 512
+# Fastest zlib level: most of the gain on msgpack, a fraction of the CPU
+ZLIB_LEVEL = 1
+
+# Write buffer sizes at which the transport pauses and resumes writing
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+
+
+def encode(message, compress: bool = False) -> bytes:
+    """Encode a packet as a complete frame, ready to be written."""
+    header, payload = frame(message.encode(), compress)
+    return header + payload
+
+
+def frame(payload: bytes, compress: bool = False) -> tuple:
+    """
+    Get the header and payload of a frame for an encoded message. With
+    `compress`, large payloads are compressed if that makes them smaller.
+    """
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, ZLIB_LEVEL)
+        if len(compressed) < len(payload):
+            return HEADER.pack(len(compressed) | FLAG_COMPRESSED), compressed
+    return HEADER.pack(len(payload)), payload
+
+
+class MessageDecoder:
+    """
+    Turns received bytes into messages.
+
+    Frames are split off by a `FrameDecoder`, then fed to one long-lived
+    `msgpack.Unpacker` that enforces the size limits. Each frame must
+    hold exactly one map.
+
+    Compressed frames are only accepted once `compression` is set.
+    """
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE,
+                 max_str_len: int = MAX_STR_LEN, max_bin_len: int = MAX_BIN_LEN,
+                 max_array_len: int = MAX_ARRAY_LEN, max_map_len: int = MAX_MAP_LEN):
+        self.max_message_size = max_message_size
+        self.compression = False
+        self._frames = FrameDecoder()
+        self._unpacker = msgpack.Unpacker(encoding='utf-8',
+                                          max_buffer_size=max_message_size,
+                                          max_str_len=max_str_len,
+                                          max_bin_len=max_bin_len,
+                                          max_array_len=max_array_len,
+                                          max_map_len=max_map_len,
+                                          max_ext_len=0)
+        # Bytes fed to the unpacker so far, to check against what it consumed
+        self._fed = 0
+
+    def feed(self, data: bytes):
+        """
+        Add received bytes and return the messages completed by them.
+        Raises ProtocolError if the peer broke the protocol.
+        """
+        self._frames.feed(data)
+        messages = []
+        for flags, data in self._frames:
+            if flags & FLAG_COMPRESSED:
+                data = self._decompress(data)
+            messages.append(self._decode(data))
+        # Refuse to wait for a frame we will not accept anyway
+        size = self._frames.pending_size()
+        if size is not None and size > self.max_message_size:
+            raise ProtocolError("Message of {} bytes exceeds the limit of {}"
+                                .format(size, self.max_message_size))
+        return messages
+
+    def take(self) -> bytes:
+        """
+        Remove and return the received bytes not decoded yet, so another
+        decoder can carry on where this one stopped.
+        """
+        return self._frames.take()
+
+    def _decompress(self, data: memoryview) -> bytes:
+        if not self.compression:
+            raise ProtocolError("Compressed message without negotiating compression")
+        # Stop inflating as soon as the result is too large
+        inflater = zlib.decompressobj()
+        try:
+            payload = inflater.decompress(data, self.max_message_size)
+        except zlib.error as e:
+            raise ProtocolError("Message could not be decompressed: {}".format(e)) from e
+        if inflater.unconsumed_tail:
+            raise ProtocolError("Decompressed message exceeds the limit of {}"
+                                .format(self.max_message_size))
+        if not inflater.eof:
+            raise ProtocolError("Message is truncated")
+        return payload
+
+    def _decode(self, payload) -> dict:
+        if len(payload) > self.max_message_size:
+            raise ProtocolError("Message of {} bytes exceeds the limit of {}"
+                                .format(len(payload), self.max_message_size))
+        self._fed += len(payload)
+        try:
+            self._unpacker.feed(payload)
+            msg = self._unpacker.unpack()
+        except msgpack.OutOfData:
+            raise ProtocolError("Message is truncated")
+        except (msgpack.UnpackException, ValueError) as e:
+            raise ProtocolError("Message could not be decoded: {}".format(e)) from e
+        if self._unpacker.tell() != self._fed:
+            raise ProtocolError("Frame holds more than one message")
+        if not isinstance(msg, dict) or 'id' not in msg:
+            raise ProtocolError("Message is not a packet")
+        return msg
+
+
+class FrameWriter:
+    """
+    Writes packets as frames to a transport.
+
+    Packets written during the same event loop iteration are coalesced
+    into one `transport.writelines` call at the end of it. While the
+    transport is above its high-water mark, `drain` waits for it to go
+    below the low-water mark again, so producers can slow down.
+
+    Large packets are compressed once `compression` is set.
+    """
+
+    def __init__(self, transport, high_water: int = WRITE_HIGH_WATER, low_water: int = WRITE_LOW_WATER):
+        self.transport = transport
+        self.high_water = high_water
+        self.compression = False
+        transport.set_write_buffer_limits(high=high_water, low=low_water)
+        self._loop = asyncio.get_event_loop()
+        self._queue = []
+        self._queued_bytes = 0
+        self._flush_handle = None
+        self._paused = False
+        self._waiters = []
+
+    def write(self, message):
+        """Queue a packet. Must be called on the event loop's thread."""
+        if self.transport.is_closing():
+            raise ConnectionError("Connection is already closed")
+        header, payload = frame(message.encode(), self.compression)
+        self._queue.append(header)
+        self._queue.append(payload)
+        self._queued_bytes += HEADER.size + len(payload)
+        self._queued()
+
+    def write_frame(self, data: bytes):
+        """
+        Queue a frame that was already encoded (see `encode`), e.g. once for
+        many connections. It must be compressed only if `compression` is set.
+        """
+        if self.transport.is_closing():
+            raise ConnectionError("Connection is already closed")
+        self._queue.append(data)
+        self._queued_bytes += len(data)
+        self._queued()
+
+    def _queued(self):
+        if self._queued_bytes >= self.high_water:
+            # Let the transport see it, so it can push back
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """Hand everything queued to the transport now."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._queue:
+            queue, self._queue = self._queue, []
+            self._queued_bytes = 0
+            self.transport.writelines(queue)
+
+    async def drain(self):
+        """Wait until the peer has caught up, if the transport is paused."""
+        if self.transport.is_closing():
+            raise ConnectionError("Connection is already closed")
+        if not self._paused:
+            return
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake(None)
+
+    def close(self):
+        """Flush and close the transport."""
+        self.flush()
+        self.transport.close()
+
+    def connection_lost(self, exc: Exception = None):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._queue.clear()
+        self._wake(exc or ConnectionError("Connection lost"))
+
+    def _wake(self, exc):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
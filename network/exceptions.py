@@ -0,0 +1,19 @@
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends something that is not a valid message, or
+    a message larger than we are willing to accept. The connection
+    cannot be trusted to stay in sync afterwards and should be closed.
+    """
+    pass
+
+
+class RequestRejected(Exception):
+    """
+    Raised when the server answers a request with Rejected rather than
+    the expected response. `reason_code` is a `packets.Rejected.Reason`.
+    """
+
+    def __init__(self, reason_code: int, reason_msg: str = None):
+        super().__init__(reason_msg or "Request rejected (reason {})".format(reason_code))
+        self.reason_code = reason_code
+        self.reason_msg = reason_msg
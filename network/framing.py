@@ -0,0 +1,79 @@
+"""
+Length-prefixed framing: every message on the wire is preceded by its
+size as a little-endian uint32. The top bit of the size is a flag and
+not part of it.
+"""
+import struct
+
+HEADER = struct.Struct("<I")
+
+# The frame's payload is compressed (only once the peers agreed on it)
+FLAG_COMPRESSED = 0x80000000
+SIZE_MASK = 0x7fffffff
+
+
+class FrameDecoder:
+    """
+    Splits a received byte stream into frames.
+
+    Chunks are appended to a single buffer that is read through a cursor,
+    and frames are handed out as memoryview slices of it, so no frame is
+    copied. A header split across chunks simply waits for the rest.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def feed(self, data: bytes):
+        """
+        Add received bytes. Every frame from the previous iteration must
+        have been consumed first (the buffer cannot move while viewed).
+        """
+        if self._pos:
+            # Only the unconsumed tail (at most one partial frame) remains,
+            # and deleting from the front of a bytearray does not copy it.
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += data
+
+    def __iter__(self):
+        """
+        Yield (flags, frame) for every complete frame received so far, the
+        frame as a memoryview. Each view is released as soon as the next
+        one is requested.
+        """
+        buffer = self._buffer
+        available = len(buffer) - self._pos
+        if available < HEADER.size or \
+                available < HEADER.size + (HEADER.unpack_from(buffer, self._pos)[0] & SIZE_MASK):
+            # Nothing complete yet: skip creating the view
+            return
+        with memoryview(buffer) as view:
+            while len(buffer) - self._pos >= HEADER.size:
+                header = HEADER.unpack_from(buffer, self._pos)[0]
+                size = header & SIZE_MASK
+                start = self._pos + HEADER.size
+                end = start + size
+                if end > len(buffer):
+                    break
+                self._pos = end
+                with view[start:end] as frame:
+                    yield header & FLAG_COMPRESSED, frame
+
+    def pending_size(self):
+        """Get the size announced by the next frame's header, or None if it has not arrived."""
+        if len(self._buffer) - self._pos < HEADER.size:
+            return None
+        return HEADER.unpack_from(self._buffer, self._pos)[0] & SIZE_MASK
+
+    def take(self) -> bytes:
+        """Remove and return the bytes not yet handed out (a partial frame)."""
+        data = bytes(self._buffer[self._pos:])
+        self._buffer = bytearray()
+        self._pos = 0
+        return data
+
+    def __len__(self):
+        """Number of buffered bytes not yet handed out."""
+        return len(self._buffer) - self._pos
@@ -0,0 +1,9 @@
+"""
+Master server: the list of game servers that clients browse. Game
+servers are listed by `network.master.client.Advertiser` and the lobby
+reads the list through `network.master.client.MasterClient`.
+"""
+
+# Where clients and game servers find the master server by default
+MASTER_ADDRESS = 'localhost'
+MASTER_PORT = 27016
@@ -0,0 +1,112 @@
+"""
+Talking to the master server (see `network.master.server`): game servers
+keep themselves listed with an `Advertiser`, and the lobby keeps a copy
+of the list with a `MasterClient`.
+"""
+import asyncio
+import logging
+
+from network import codec, packets
+from network.client.client import Client, ClientHandler
+from network.exceptions import ProtocolError
+from network.master import MASTER_ADDRESS, MASTER_PORT
+
+master_logger = logging.getLogger("ac.net.master.client")
+
+# Seconds to wait before connecting again after losing the master server
+RETRY_DELAY = 15
+
+# The whole list may come in one response, so the master server may send
+# far larger messages than a game server
+LIST_LIMITS = dict(max_message_size=16 * 1024 * 1024, max_array_len=256 * 1024)
+
+
+class Advertiser:
+    """Keeps a game server listed on the master server while it runs."""
+
+    def __init__(self, server, address: str = MASTER_ADDRESS, port: int = MASTER_PORT):
+        self.server = server
+        self.address = address
+        self.port = port
+        self._task = None
+        self._client = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+        if self._client is not None:
+            self._client.close()
+
+    async def run(self):
+        while self._task is not None:
+            self._client = Client(self.address, self.port, master=False)
+            self._client.handler = ClientHandler(self._client)
+            try:
+                await self._client.connect()
+                while True:
+                    response = await self._client.request(self.server.heartbeat(), packets.HeartbeatResponse)
+                    await asyncio.sleep(response['interval'])
+            except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+                master_logger.warning("Could not reach the master server: %s", e)
+            self._client.close()
+            self._client = None
+            await asyncio.sleep(RETRY_DELAY)
+
+
+class MasterClient:
+    """
+    A copy of the master server's list of game servers. Each refresh only
+    downloads what changed since the last one.
+    """
+
+    def __init__(self, address: str = MASTER_ADDRESS, port: int = MASTER_PORT):
+        self.address = address
+        self.port = port
+        # Listings by key (see ServerListResponse)
+        self.servers = dict()
+        self.epoch = None
+        self.version = None
+        self._client = None
+        self._disconnected = None
+
+    async def connect(self):
+        self._client = Client(self.address, self.port, master=False, limits=LIST_LIMITS)
+        self._client.handler = ClientHandler(self._client)
+        self._disconnected = asyncio.get_event_loop().create_future()
+        await self._client.connect(self._disconnected)
+        # The list is sent compressed if it is large
+        self._client.accept_compression()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def refresh(self) -> tuple:
+        """
+        Bring the list up to date. Returns the listings that were added or
+        changed, and the keys of those that were removed.
+        """
+        if self._client is None or self._disconnected.done():
+            await self.connect()
+        response = await self._client.request(
+            packets.ServerListRequest(self.epoch, self.version, compression=[codec.COMPRESSION]),
+            packets.ServerListResponse)
+        removed = response['removed']
+        if response['full']:
+            keys = {server['key'] for server in response['servers']}
+            removed = [key for key in self.servers if key not in keys]
+            self.servers.clear()
+        for key in removed:
+            self.servers.pop(key, None)
+        for server in response['servers']:
+            self.servers[server['key']] = server
+        # A server may have been removed and listed again since
+        removed = [key for key in removed if key not in self.servers]
+        self.epoch = response['epoch']
+        self.version = response['version']
+        return response['servers'], removed
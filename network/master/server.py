@@ -0,0 +1,319 @@
+"""
+The master server keeps the list of game servers in memory.
+
+Game servers stay connected and send a Heartbeat every so often; a
+listing that is not renewed within its TTL is dropped. Clients send
+ServerListRequest. Every change to the list gives it a new version, and
+a client that says which version it has gets only the listings changed
+and removed since then, rather than the whole list again.
+
+The listings in a response are encoded once per list version and
+shared by every client that asks for the same thing; only the few fields
+around them, the request's sequence number among them, are packed per
+request.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from network import codec, packets
+from network.exceptions import ProtocolError
+from network.master import MASTER_PORT
+from network.server.admission import Admission
+
+master_logger = logging.getLogger("ac.net.master")
+
+# Seconds a listing lasts without a heartbeat, and how often game servers
+# are asked to send one
+TTL = 90
+HEARTBEAT_INTERVAL = 30
+
+# How often expired listings are looked for
+SWEEP_INTERVAL = 5
+
+# Removals remembered for deltas. A client whose version is older than
+# the oldest of them gets the whole list.
+MAX_REMOVALS = 4096
+
+# Seconds a connection may stay silent
+IDLE_TIMEOUT = TTL
+
+
+class Listing:
+    """
+    key:
+        "address:port" of the game server
+    info:
+        The listing as sent to clients
+    encoded:
+        `info`, msgpack-encoded
+    changed:
+        List version the listing last changed in
+    expires:
+        When the listing is dropped unless renewed
+    """
+    __slots__ = \
+        'key', \
+        'info', \
+        'encoded', \
+        'changed', \
+        'expires'
+
+    def __init__(self, key: str):
+        self.key = key
+        self.info = None
+        self.encoded = None
+        self.changed = 0
+        self.expires = 0
+
+
+class ServerList:
+    """
+    The listings, versioned so that clients can catch up with deltas.
+
+    Listings are kept in the order they last changed, so the ones changed
+    since a version are found from the end without looking at the rest.
+    """
+
+    def __init__(self, ttl: float = TTL, max_removals: int = MAX_REMOVALS, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        # Versions only mean something within one run of the master server
+        self.epoch = os.urandom(8).hex()
+        self.version = 0
+        self.listings = OrderedDict()
+        # (version, key) of every removal remembered, oldest first
+        self.removals = deque(maxlen=max_removals)
+        # Responses for the current version, by the version they catch up from
+        self._responses = dict()
+
+    def __len__(self):
+        return len(self.listings)
+
+    def update(self, address: str, heartbeat: dict) -> str:
+        """List a game server, or renew its listing. Returns its key."""
+        key = "{}:{}".format(address, heartbeat['port'])
+        info = {'key': key, 'address': address}
+        for name in packets.Heartbeat.fields:
+            info[name] = heartbeat.get(name)
+        listing = self.listings.get(key)
+        if listing is None:
+            listing = self.listings[key] = Listing(key)
+        listing.expires = self.clock() + self.ttl
+        if info != listing.info:
+            listing.info = info
+            listing.encoded = packets.Encoded.of(info)
+            listing.changed = self._bump()
+            self.listings.move_to_end(key)
+        return key
+
+    def remove(self, key: str):
+        if self.listings.pop(key, None) is not None:
+            self.removals.append((self._bump(), key))
+
+    def expire(self):
+        """Drop the listings that were not renewed in time."""
+        now = self.clock()
+        for key in [key for key, listing in self.listings.items() if listing.expires < now]:
+            master_logger.info("Delisting %s: no heartbeat", key)
+            self.remove(key)
+
+    def _bump(self) -> int:
+        self.version += 1
+        self._responses.clear()
+        return self.version
+
+    def can_catch_up(self, epoch: str, since: int) -> bool:
+        """Whether a client with version `since` can be sent a delta."""
+        if epoch != self.epoch or not isinstance(since, int) or since > self.version:
+            return False
+        # Removals after `since` must not have been forgotten
+        return len(self.removals) < self.removals.maxlen or self.removals[0][0] <= since + 1
+
+    def response(self, epoch: str, since: int) -> packets.ServerListResponse:
+        """
+        Get a response to a ServerListRequest. Its listings are already
+        encoded, and shared with the other responses of this version.
+        """
+        if not self.can_catch_up(epoch, since):
+            since = None
+        shared = self._responses.get(since)
+        if shared is None:
+            shared = self._responses[since] = self._encode(since)
+        return packets.ServerListResponse(shared.epoch, shared.version, shared.full, shared.servers,
+                                          shared.removed)
+
+    def _encode(self, since: int = None) -> packets.ServerListResponse:
+        if since is None:
+            servers = [listing.encoded for listing in self.listings.values()]
+            return packets.ServerListResponse(self.epoch, self.version, True, packets.Encoded.array(servers),
+                                              packets.Encoded.of([]))
+        servers = []
+        for listing in reversed(self.listings.values()):
+            if listing.changed <= since:
+                break
+            servers.append(listing.encoded)
+        removed = []
+        for version, key in reversed(self.removals):
+            if version <= since:
+                break
+            removed.append(key)
+        return packets.ServerListResponse(self.epoch, self.version, False, packets.Encoded.array(servers),
+                                          packets.Encoded.of(removed))
+
+
+class MasterServer:
+
+    def __init__(self, address='0.0.0.0', port=MASTER_PORT, ttl: float = TTL,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL, admission: Admission = None):
+        self.address = address
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.servers = ServerList(ttl)
+        # The connection each listed game server heartbeats on, by key
+        self.advertisers = dict()
+        self.admission = admission or Admission()
+        self.server = None
+        self._sweeper = None
+
+    async def start(self):
+        """Start accepting connections."""
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(lambda: MasterProtocol(self), self.address, self.port)
+        self._sweeper = loop.call_later(SWEEP_INTERVAL, self.sweep)
+        master_logger.info("Master server listening on %s:%d", self.address, self.port)
+
+    def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self.server is not None:
+            self.server.close()
+
+    def sweep(self):
+        self.servers.expire()
+        self._sweeper = asyncio.get_event_loop().call_later(SWEEP_INTERVAL, self.sweep)
+
+    def metrics(self) -> dict:
+        """Get counters for monitoring (see `Admission`)."""
+        return dict(self.admission.metrics(), servers=len(self.servers), version=self.servers.version)
+
+
+class MasterProtocol(asyncio.Protocol):
+
+    def __init__(self, server: MasterServer):
+        super().__init__()
+        self.server = server
+        self.transport = None
+        self.writer = None
+        self.peer = None
+        self.admitted = False
+        self.drop_timer = None
+        # Key of the game server this connection advertises, if any
+        self.listing = None
+        self._decoder = codec.MessageDecoder()
+        self.handlers = {
+            'Heartbeat': self.heartbeat,
+            'ServerListRequest': self.server_list,
+            'Goodbye': self.goodbye,
+        }
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        peername = transport.get_extra_info('peername')
+        self.peer = peername[0] if isinstance(peername, tuple) else None
+        if not self.server.admission.admit(self.peer):
+            master_logger.info("Refusing connection from %s", self.peer)
+            transport.abort()
+            return
+        self.admitted = True
+        self.writer = codec.FrameWriter(transport)
+        self.touch()
+
+    def connection_lost(self, exc: Exception):
+        if not self.admitted:
+            return
+        self.writer.connection_lost(exc)
+        if self.drop_timer is not None:
+            self.drop_timer.cancel()
+        self.delist()
+        self.server.admission.release(self.peer)
+
+    def delist(self):
+        """Delist the game server this connection advertises, if it still does."""
+        if self.listing is not None and self.server.advertisers.get(self.listing) is self:
+            del self.server.advertisers[self.listing]
+            self.server.servers.remove(self.listing)
+        self.listing = None
+
+    def touch(self):
+        """Put off dropping the connection for being idle."""
+        if self.drop_timer is not None:
+            self.drop_timer.cancel()
+        self.drop_timer = asyncio.get_event_loop().call_later(IDLE_TIMEOUT, self.idle_timeout)
+
+    def idle_timeout(self):
+        self.drop_timer = None
+        master_logger.debug("Dropping %s: idle", self.peer)
+        self.transport.abort()
+
+    def pause_writing(self):
+        self.writer.pause_writing()
+
+    def resume_writing(self):
+        self.writer.resume_writing()
+
+    def data_received(self, data: bytes):
+        try:
+            messages = self._decoder.feed(data)
+        except ProtocolError as e:
+            master_logger.warning("Dropping %s: %s", self.peer, e)
+            self.server.admission.counters['protocol_errors'] += 1
+            self.transport.close()
+            return
+        self.touch()
+        for msg in messages:
+            handler = self.handlers.get(msg['id'])
+            if handler is not None:
+                handler(msg)
+            else:
+                master_logger.warning("Unknown packet %s", msg['id'])
+
+    def heartbeat(self, msg: dict):
+        if not isinstance(msg.get('port'), int):
+            return
+        key = self.server.servers.update(self.peer, msg)
+        # One game server per connection
+        if self.listing != key:
+            self.delist()
+        self.listing = key
+        self.server.advertisers[key] = self
+        response = packets.HeartbeatResponse(self.server.heartbeat_interval)
+        response.seq = msg.get('seq')
+        self.writer.write(response)
+
+    def server_list(self, msg: dict):
+        compression = msg.get('compression') or ()
+        if codec.COMPRESSION in compression:
+            self.writer.compression = True
+            self._decoder.compression = True
+        response = self.server.servers.response(msg.get('epoch'), msg.get('since'))
+        response.seq = msg.get('seq')
+        self.writer.write(response)
+
+    def goodbye(self, msg: dict):
+        # A game server saying goodbye is shutting down
+        self.delist()
+        self.transport.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = MasterServer()
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
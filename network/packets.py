@@ -1,19 +1,101 @@
 """
 Contains all network packets.
+
+Every packet declares its fields in `__slots__`, in wire order. Packets
+are encoded as msgpack maps of the packet id and those fields; the parts
+that never change (the map header, the id and the field names) are
+packed once per class.
 """
+import threading
+
 import msgpack
 import logging
 
 logger = logging.getLogger("ac.net.packets")
 
+_local = threading.local()
+
+
+def _encode_object(obj):
+    """Encode nested values such as `SetBackground.Transition` as maps of their slots."""
+    try:
+        return {name: getattr(obj, name) for name in obj.__slots__}
+    except AttributeError:
+        raise TypeError("Cannot encode {!r}".format(obj))
+
+
+def _packer() -> msgpack.Packer:
+    """Get this thread's packer (packers keep state between calls)."""
+    try:
+        return _local.packer
+    except AttributeError:
+        _local.packer = msgpack.Packer(use_bin_type=True, default=_encode_object)
+        return _local.packer
+
+
+class Encoded(bytes):
+    """A field value that is already msgpack-encoded, written as it is."""
+
+    @classmethod
+    def of(cls, value) -> 'Encoded':
+        return cls(_packer().pack(value))
+
+    @classmethod
+    def array(cls, items) -> 'Encoded':
+        """Join already encoded values into an array."""
+        items = list(items)
+        return cls(_packer().pack_array_header(len(items)) + b''.join(items))
+
 
 class Packet:
     msgid = None
 
-    def encode(self):
+    # Set on requests by the sender; responses echo it back so they can be
+    # matched to the request that caused them. Left out of the encoding
+    # while unset.
+    __slots__ = 'seq',
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = cls.__dict__.get('__slots__', ())
+        if isinstance(fields, str):
+            fields = (fields,)
+        packer = _packer()
+        cls.fields = fields
+        cls._keys = tuple(packer.pack(name) for name in fields)
+        id_entry = packer.pack('id') + packer.pack(cls.msgid)
+        cls._header = packer.pack_map_header(len(fields) + 1) + id_entry
+        cls._seq_header = packer.pack_map_header(len(fields) + 2) + id_entry + packer.pack('seq')
+
+    def encode(self) -> bytes:
         """Encode the message using msgpack."""
-        logger.debug("writing: %s", self.__dict__)
-        return msgpack.packb(self.__dict__, use_bin_type=True)
+        logger.debug("writing: %r", self)
+        pack = _packer().pack
+        seq = getattr(self, 'seq', None)
+        if seq is None:
+            parts = [self._header]
+        else:
+            parts = [self._seq_header, pack(seq)]
+        for key, name in zip(self._keys, self.fields):
+            parts.append(key)
+            value = getattr(self, name)
+            parts.append(value if type(value) is Encoded else pack(value))
+        return b''.join(parts)
+
+    @classmethod
+    def from_message(cls, msg: dict):
+        """
+        Build a packet from a received message, taking only the fields this
+        packet declares (missing ones are None).
+        """
+        packet = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(packet, name, msg.get(name))
+        return packet
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name, None)) for name in ('seq',) + self.fields))
 
 
 class ServerInfoRequest(Packet):
@@ -23,10 +105,14 @@ class ServerInfoRequest(Packet):
         FULL = 2
 
     msgid = 'ServerInfoRequest'
+    __slots__ = \
+        'type', \
+        'compression'
 
-    def __init__(self, request_type: ServerInfoRequestType):
-        self.id = self.msgid
+    def __init__(self, request_type: ServerInfoRequestType, compression: list = None):
         self.type = request_type
+        # Compression schemes the client supports
+        self.compression = compression
 
 
 class ServerInfoResponse(Packet):
@@ -38,15 +124,31 @@ class ServerInfoResponse(Packet):
         CLOSED = 4
 
     class Details:
-        def __init__(self, auth_challenge: bytes, desc: str, players: list):
-            self.auth_challenge = auth_challenge
+        __slots__ = \
+            'desc', \
+            'players'
+
+        def __init__(self, desc: str, players: list):
             self.desc = desc
             self.players = players
 
     msgid = 'ServerInfoResponse'
+    __slots__ = \
+        'name', \
+        'address', \
+        'port', \
+        'version', \
+        'player_count', \
+        'max_players', \
+        'protection', \
+        'auth_challenge', \
+        'details', \
+        'rooms', \
+        'compression'
 
     def __init__(self, name: str, address: str, port: int, version: str, player_count: int,
-                 max_players: int, protection: int, details: Details):
+                 max_players: int, protection: int, auth_challenge: bytes = None, details: Details = None,
+                 rooms: list = None, compression: str = None):
         self.name = name
         self.address = address
         self.port = port
@@ -54,18 +156,54 @@ class ServerInfoResponse(Packet):
         self.player_count = player_count
         self.max_players = max_players
         self.protection = protection
+        # Nonce that password hashes are salted with, for the whole connection
+        self.auth_challenge = auth_challenge
         self.details = details
+        # Only in full responses: see RoomListResponse
+        self.rooms = rooms
+        # Compression scheme picked from the request's, if any
+        self.compression = compression
+
+
+class Rejected(Packet):
+    class Reason:
+        OTHER = 0
+        NOT_IN_ROOM = 1
+        RATE_LIMITED = 2
+
+    msgid = 'Rejected'
+    __slots__ = \
+        'reason_code', \
+        'reason_msg'
+
+    def __init__(self, reason_code: Reason, reason_msg: str = None):
+        # Sent instead of the response to a request the server would not carry out
+        self.reason_code = reason_code
+        self.reason_msg = reason_msg
+
+
+class PingResponse(Packet):
+    msgid = 'PingResponse'
+    __slots__ = ()
 
 
 class JoinRequest(Packet):
     msgid = 'JoinRequest'
-
-    def __init__(self, *, player_name: str, player_id: str, auth_response: bytes = None, master: bool = True):
-        self.id = self.msgid
+    __slots__ = \
+        'player_id', \
+        'player_name', \
+        'auth_response', \
+        'master', \
+        'compression'
+
+    def __init__(self, *, player_name: str, player_id: str, auth_response: bytes = None, master: bool = True,
+                 compression: str = None):
         self.player_id = player_id
         self.player_name = player_name
         self.auth_response = auth_response
         self.master = master
+        # Compression scheme to use from here on, if any
+        self.compression = compression
 
 
 class JoinResponse(Packet):
@@ -77,28 +215,39 @@ class JoinResponse(Packet):
         OTHER = 4
 
     msgid = 'JoinResponse'
-
-    def __init__(self, result: JoinResult, msg: str):
-        self.id = self.msgid
-        self.result = result
-        self.msg = msg
+    __slots__ = \
+        'result_code', \
+        'result_msg', \
+        'player_id'
+
+    def __init__(self, result_code: JoinResult, result_msg: str = None, player_id: int = None):
+        self.result_code = result_code
+        self.result_msg = result_msg
+        # The ID the server assigned to the player, on success
+        self.player_id = player_id
 
 
 class RoomListRequest(Packet):
     msgid = 'RoomListRequest'
+    __slots__ = ()
 
-    def __init__(self):
-        self.id = self.msgid
 
 class RoomListResponse(Packet):
     msgid = 'RoomListResponse'
+    __slots__ = 'rooms',
+
+    def __init__(self, rooms: list):
+        # Maps with id, name, description, protection, players and max_players
+        self.rooms = rooms
 
 
 class JoinRoomRequest(Packet):
     msgid = 'JoinRoomRequest'
+    __slots__ = \
+        'room_id', \
+        'auth_response'
 
     def __init__(self, room_id: int, auth_response: bytes = None):
-        self.id = self.msgid
         self.room_id = room_id
         self.auth_response = auth_response
 
@@ -110,14 +259,23 @@ class JoinRoomResponse(Packet):
         BAD_PASSWORD = 2
 
     msgid = 'JoinRoomResponse'
+    __slots__ = \
+        'result_code', \
+        'result_msg'
 
-    def __init__(self, result: JoinRoomResult):
-        self.id = self.msgid
-        self.result_msg = result
+    def __init__(self, result_code: JoinRoomResult, result_msg: str = None):
+        self.result_code = result_code
+        self.result_msg = result_msg
 
 
 class Chat(Packet):
     msgid = 'ChatMessage'
+    __slots__ = \
+        'room_id', \
+        'text', \
+        'emote', \
+        'preanimation', \
+        'player_id'
 
     # def __init__(self, player_id: int, emote: str, msg: str, timescale: float = 1, flip: bool = False):
     #     self.id = self.msgid
@@ -127,28 +285,34 @@ class Chat(Packet):
     #     self.timescale = timescale
     #     self.flip = flip
 
-    def __init__(self, *, room_id: int, text: str, emote: str, preanimation: str):
-        self.id = self.msgid
+    def __init__(self, *, room_id: int, text: str, emote: str, preanimation: str, player_id: int = None):
         self.room_id = room_id
         self.text = text
         self.emote = emote
         self.preanimation = preanimation
+        # Filled in by the server when it relays the message
+        self.player_id = player_id
 
 
 class ChatOOC(Packet):
     msgid = 'Chat_OOC'
+    __slots__ = \
+        'player_id', \
+        'msg'
 
     def __init__(self, player_id: int, msg: str):
-        self.id = self.msgid
         self.player_id = player_id
         self.msg = msg
 
 
 class Join(Packet):
     msgid = 'Join'
+    __slots__ = \
+        'player_id', \
+        'player_name', \
+        'char_id'
 
     def __init__(self, player_id: int, player_name: str, char_id: str):
-        self.id = self.msgid
         self.player_id = player_id
         self.player_name = player_name
         self.char_id = char_id
@@ -156,9 +320,9 @@ class Join(Packet):
 
 class Leave(Packet):
     msgid = 'Leave'
+    __slots__ = 'player_id',
 
     def __init__(self, player_id: int):
-        self.id = self.msgid
         self.player_id = player_id
 
 
@@ -170,9 +334,11 @@ class Disconnect(Packet):
         BANNED = 3
 
     msgid = 'Disconnect'
+    __slots__ = \
+        'cause', \
+        'player_id'
 
     def __init__(self, cause: DisconnectCause, player_id: int):
-        self.id = self.msgid
         self.cause = cause
         self.player_id = player_id
 
@@ -185,23 +351,32 @@ class SetBackground(Packet):
             CROSSFADE = 2
             FADE_TO_WHITE = 3
 
+        __slots__ = \
+            'type', \
+            'time'
+
         def __init__(self, transition_type: TransitionType, time: float):
             self.type = transition_type
             self.time = time
 
     msgid = 'SetBackground'
+    __slots__ = \
+        'name', \
+        'transition'
 
     def __init__(self, name: str, transition: Transition = None):
-        self.id = self.msgid
         self.name = name
         self.transition = transition
 
 
 class SoundPlay(Packet):
     msgid = 'SoundPlay'
+    __slots__ = \
+        'name', \
+        'channel', \
+        'loop'
 
     def __init__(self, name: str, channel: int, loop: bool = False):
-        self.id = self.msgid
         self.name = name
         self.channel = channel
         self.loop = loop
@@ -209,36 +384,105 @@ class SoundPlay(Packet):
 
 class SoundStop(Packet):
     msgid = 'SoundStop'
+    __slots__ = 'channel',
 
     def __init__(self, channel: int):
-        self.id = self.msgid
         self.channel = channel
 
 
 class SoundVolume(Packet):
     msgid = 'SoundVolume'
+    __slots__ = \
+        'channel', \
+        'smooth'
 
     def __init__(self, channel: int, smooth: bool = False):
-        self.id = self.msgid
         self.channel = channel
         self.smooth = smooth
 
 
 class Goodbye(Packet):
     msgid = 'Goodbye'
-
-    def __init__(self):
-        self.id = self.msgid
+    __slots__ = ()
 
 
 class AssetListRequest(Packet):
     msgid = 'AssetListRequest'
+    __slots__ = ()
 
-    def __init__(self):
-        self.id = self.msgid
 
 class AssetListResponse(Packet):
     msgid = 'AssetListResponse'
+    __slots__ = ()
+
+
+# Master server (see network.master)
+
+class Heartbeat(Packet):
+    msgid = 'Heartbeat'
+    __slots__ = \
+        'port', \
+        'name', \
+        'description', \
+        'version', \
+        'player_count', \
+        'max_players', \
+        'protection'
+
+    def __init__(self, port: int, name: str, description: str, version: str, player_count: int,
+                 max_players: int, protection: int):
+        # The master server lists the address the heartbeat came from
+        self.port = port
+        self.name = name
+        self.description = description
+        self.version = version
+        self.player_count = player_count
+        self.max_players = max_players
+        self.protection = protection
+
+
+class HeartbeatResponse(Packet):
+    msgid = 'HeartbeatResponse'
+    __slots__ = 'interval',
+
+    def __init__(self, interval: float):
+        # Seconds until the next heartbeat is due
+        self.interval = interval
+
 
-    def __init__(self):
-        self.id = self.msgid
\ No newline at end of file
+class ServerListRequest(Packet):
+    msgid = 'ServerListRequest'
+    __slots__ = \
+        'epoch', \
+        'since', \
+        'compression'
+
+    def __init__(self, epoch: str = None, since: int = None, compression: list = None):
+        # The list version the client already has, if any, and the epoch
+        # of the master server it came from
+        self.epoch = epoch
+        self.since = since
+        # Compression schemes the client supports
+        self.compression = compression
+
+
+class ServerListResponse(Packet):
+    msgid = 'ServerListResponse'
+    __slots__ = \
+        'epoch', \
+        'version', \
+        'full', \
+        'servers', \
+        'removed'
+
+    def __init__(self, epoch: str, version: int, full: bool, servers: list, removed: list):
+        self.epoch = epoch
+        self.version = version
+        # Whether `servers` is the whole list, or only what changed since
+        # the requested version
+        self.full = full
+        # Maps with key, address, port, name, description, version,
+        # player_count, max_players and protection
+        self.servers = servers
+        # Keys of the servers delisted since the requested version
+        self.removed = removed
@@ -0,0 +1,109 @@
+"""
+Admission control: limits on who may connect and how fast they may
+talk, so that a flood cannot exhaust file descriptors or the event loop.
+"""
+import time
+from collections import Counter
+
+# Most connections open at once, from one address and in total
+MAX_CONNECTIONS_PER_IP = 8
+MAX_CONNECTIONS = 4096
+
+# Chat messages per second a connection may send on average, and in a burst
+CHAT_RATE = 4.0
+CHAT_BURST = 10
+
+
+class TokenBucket:
+    """
+    rate:
+        Tokens added per second
+    capacity:
+        Most tokens the bucket holds (the largest burst allowed)
+    tokens:
+        Tokens currently in the bucket
+    updated:
+        When `tokens` was last brought up to date
+    """
+    __slots__ = \
+        'rate', \
+        'capacity', \
+        'tokens', \
+        'updated'
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = clock()
+
+    def take(self, now: float = None) -> bool:
+        """Take a token if there is one. Returns whether there was."""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Admission:
+    """
+    Counts open connections per address and decides whether to accept
+    new ones, and sets how fast each connection may chat. `counters`
+    holds totals for monitoring:
+
+    accepted:
+        Connections accepted
+    rejected_ip_limit:
+        Connections refused because their address had too many open
+    rejected_full:
+        Connections refused because the server had too many open
+    handshake_timeouts:
+        Connections closed for not finishing the handshake in time
+    rate_limited:
+        Chat messages dropped for coming too fast
+    protocol_errors:
+        Connections closed for breaking the protocol
+    """
+
+    def __init__(self, max_per_ip: int = MAX_CONNECTIONS_PER_IP, max_connections: int = MAX_CONNECTIONS,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST):
+        self.max_per_ip = max_per_ip
+        self.max_connections = max_connections
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.open = Counter()
+        self.open_total = 0
+        self.counters = Counter()
+
+    def admit(self, address: str) -> bool:
+        """Account for a new connection from `address`, if it may be accepted."""
+        if self.open_total >= self.max_connections:
+            self.counters['rejected_full'] += 1
+            return False
+        if address is not None and self.open[address] >= self.max_per_ip:
+            self.counters['rejected_ip_limit'] += 1
+            return False
+        if address is not None:
+            self.open[address] += 1
+        self.open_total += 1
+        self.counters['accepted'] += 1
+        return True
+
+    def chat_bucket(self) -> TokenBucket:
+        """Get the chat rate limit for a new connection."""
+        return TokenBucket(self.chat_rate, self.chat_burst)
+
+    def release(self, address: str):
+        """A connection admitted from `address` was closed."""
+        if address is not None:
+            self.open[address] -= 1
+            if self.open[address] <= 0:
+                del self.open[address]
+        self.open_total -= 1
+
+    def metrics(self) -> dict:
+        return dict(self.counters, open=self.open_total, addresses=len(self.open))
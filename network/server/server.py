@@ -1,22 +1,303 @@
 import asyncio
-import msgpack
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+
+from network import codec, packets
+from network.exceptions import ProtocolError
+from network.master.client import Advertiser
+from network.server.admission import Admission
+
+server_logger = logging.getLogger("ac.net.server")
+
+VERSION = '0.1'
+
+# A connection that has this many bytes waiting to be sent is not keeping
+# up with its room, and is dropped rather than buffered for.
+MAX_BACKLOG = 4 * 1024 * 1024
+
+# Seconds a new connection has to ask for server info (anything else
+# connecting is background Internet traffic), and then to join
+HANDSHAKE_TIMEOUT = 4
+JOIN_TIMEOUT = 120
+
+
+def password_hash(password: str, challenge: bytes) -> bytes:
+    """Hash a password the way the client does in its auth responses."""
+    sha256 = hashlib.sha256()
+    if password is not None:
+        sha256.update(password.encode("utf-8"))
+    sha256.update(challenge)
+    return sha256.digest()
+
+
+def fan_out(players, payload: bytes, exclude=None):
+    """
+    Write an encoded packet to every player's connection. It is framed
+    once (twice at most, if some players use compression and others do
+    not) and the same bytes are written to every connection.
+    """
+    frames = dict()
+    for player in list(players):
+        if player is exclude:
+            continue
+        protocol = player.protocol
+        if protocol.transport.is_closing():
+            continue
+        if protocol.transport.get_write_buffer_size() > MAX_BACKLOG:
+            server_logger.warning("Dropping %s: not keeping up", player.name)
+            protocol.transport.close()
+            continue
+        compress = protocol.writer.compression
+        data = frames.get(compress)
+        if data is None:
+            header, body = codec.frame(payload, compress)
+            data = frames[compress] = header + body
+        protocol.writer.write_frame(data)
+
+
+class Player:
+    """
+    id:
+        ID assigned by the server, unique while the server runs
+    name:
+        Name the player joined with
+    unique_id:
+        The player's own identifier (see `network.unique`)
+    room:
+        The room the player is in, or None
+    protocol:
+        The player's connection
+    """
+    __slots__ = \
+        'id', \
+        'name', \
+        'unique_id', \
+        'room', \
+        'protocol'
+
+    def __init__(self, player_id: int, name: str, unique_id: str, protocol):
+        self.id = player_id
+        self.name = name
+        self.unique_id = unique_id
+        self.room = None
+        self.protocol = protocol
+
+
+class Room:
+    """
+    id:
+        ID of the room, as in JoinRoomRequest
+    name:
+        Name of the room
+    description:
+        Shown in the room list
+    password:
+        Password needed to join, or None
+    max_players:
+        How many players fit in the room, or None for no limit
+    members:
+        Players in the room, by ID
+    """
+    __slots__ = \
+        'id', \
+        'name', \
+        'description', \
+        'password', \
+        'max_players', \
+        'members'
+
+    def __init__(self, room_id: int, name: str, description: str = "", password: str = None,
+                 max_players: int = None):
+        self.id = room_id
+        self.name = name
+        self.description = description
+        self.password = password
+        self.max_players = max_players
+        self.members = dict()
+
+    @property
+    def protection(self) -> int:
+        if self.password is not None:
+            return packets.ServerInfoResponse.Protection.JOIN_WITH_PASSWORD
+        return packets.ServerInfoResponse.Protection.OPEN
+
+    @property
+    def full(self) -> bool:
+        return self.max_players is not None and len(self.members) >= self.max_players
+
+    def info(self) -> dict:
+        """Describe the room for room lists."""
+        return {'id': self.id, 'name': self.name, 'description': self.description,
+                'protection': self.protection, 'players': len(self.members),
+                'max_players': self.max_players}
+
+    def broadcast(self, packet: packets.Packet, exclude: Player = None):
+        """Send a packet to every member, encoding it only once."""
+        fan_out(self.members.values(), packet.encode(), exclude)
+
 
 class Server:
 
-    def __init__(self, address='0.0.0.0', port=27017):
+    def __init__(self, address='0.0.0.0', port=27017, name="Animated Chatroom", description="",
+                 password: str = None, max_players: int = 100, rooms: list = None,
+                 admission: Admission = None, master: tuple = None):
         self.address = address
         self.port = port
-        self.clients = []
+        self.name = name
+        self.description = description
+        self.password = password
+        self.max_players = max_players
+        self.rooms = {room.id: room for room in (rooms or [Room(1, "Lobby")])}
+        # Joined players, by ID
+        self.players = dict()
+        self._player_ids = itertools.count(1)
+        self.admission = admission or Admission()
+        # (address, port) of the master server to be listed on, if any
+        self.master = master
+        self.advertiser = None
+        self.server = None
+
+    async def start(self):
+        """Start accepting connections."""
         loop = asyncio.get_event_loop()
-        self.server = loop.create_server(Protocol(self), address, port)
+        self.server = await loop.create_server(lambda: Protocol(self), self.address, self.port)
+        server_logger.info("Listening on %s:%d", self.address, self.port)
+        if self.master is not None:
+            self.advertiser = Advertiser(self, *self.master)
+            self.advertiser.start()
+
+    def close(self):
+        if self.advertiser is not None:
+            self.advertiser.close()
+        if self.server is not None:
+            self.server.close()
+        for player in list(self.players.values()):
+            player.protocol.transport.close()
+
+    @property
+    def protection(self) -> int:
+        if self.player_count >= self.max_players:
+            return packets.ServerInfoResponse.Protection.CLOSED
+        if self.password is not None:
+            return packets.ServerInfoResponse.Protection.JOIN_WITH_PASSWORD
+        return packets.ServerInfoResponse.Protection.OPEN
+
+    @property
+    def player_count(self) -> int:
+        return len(self.players)
+
+    def admit(self, protocol) -> bool:
+        """Decide whether to accept a new connection."""
+        return self.admission.admit(protocol.peer)
+
+    def release(self, protocol):
+        """An accepted connection was closed."""
+        self.admission.release(protocol.peer)
+
+    def metrics(self) -> dict:
+        """Get counters for monitoring (see `Admission`)."""
+        return dict(self.admission.metrics(), players=self.player_count)
+
+    def heartbeat(self) -> packets.Heartbeat:
+        """Describe the server for its master server listing."""
+        return packets.Heartbeat(self.port, self.name, self.description, VERSION,
+                                 self.player_count, self.max_players, self.protection)
+
+    def player_list(self) -> list:
+        """Describe the players for ServerInfoResponse details."""
+        return [{'name': player.name, 'player_id': player.id} for player in self.players.values()]
+
+    def room_list(self) -> list:
+        """Describe the rooms for room lists."""
+        return [room.info() for room in self.rooms.values()]
+
+    def route(self, protocol, msg: dict) -> bool:
+        """
+        Called with every JoinRoomRequest before it is handled here.
+        Returns True if the request was passed on to be handled elsewhere.
+        """
+        return False
+
+    def broadcast(self, packet: packets.Packet):
+        """Send a packet to every player on the server."""
+        self.deliver(packet.encode())
+
+    def deliver(self, payload: bytes):
+        """Send an encoded packet to every player connected to this process."""
+        fan_out(self.players.values(), payload)
+
+    def add_player(self, name: str, unique_id: str, protocol, player_id: int = None) -> Player:
+        if player_id is None:
+            player_id = next(self._player_ids)
+        player = Player(player_id, name, unique_id, protocol)
+        self.players[player.id] = player
+        server_logger.info("%s joined as player %d", name, player.id)
+        return player
+
+    def remove_player(self, player: Player, cause: int = packets.Disconnect.DisconnectCause.UNSPECIFIED):
+        """The player left the server."""
+        self.release_player(player)
+        server_logger.info("%s (player %d) left", player.name, player.id)
+        self.broadcast(packets.Disconnect(cause, player.id))
+
+    def release_player(self, player: Player):
+        """Stop serving the player here, without telling anyone it left."""
+        self.leave_room(player)
+        self.players.pop(player.id, None)
+
+    def join_room(self, player: Player, room: Room):
+        self.leave_room(player)
+        room.members[player.id] = player
+        player.room = room
+        room.broadcast(packets.Join(player.id, player.name, None), exclude=player)
+
+    def leave_room(self, player: Player):
+        room = player.room
+        if room is None:
+            return
+        del room.members[player.id]
+        player.room = None
+        room.broadcast(packets.Leave(player.id))
 
 
 class Protocol(asyncio.Protocol):
 
+    # Packets relayed as they are to the sender's room
+    relayed = {packet.msgid: packet for packet in
+               (packets.SetBackground, packets.SoundPlay, packets.SoundStop, packets.SoundVolume)}
+
     def __init__(self, server: Server):
         super().__init__()
         self.server = server
         self.client = None
+        self.transport = None
+        self.writer = None
+        # Address of the other end, and whether the server accepted it
+        self.peer = None
+        self.admitted = False
+        self.drop_timer = None
+        self.chat_bucket = server.admission.chat_bucket()
+        self.challenge = os.urandom(16)
+        self.disconnect_cause = packets.Disconnect.DisconnectCause.UNSPECIFIED
+        # While being handed to another process: the state to hand over
+        self.handoff = None
+        # Whether the connection was let go of for another process to serve.
+        # Until then, losing it is a disconnect like any other.
+        self.handed_off = False
+        self._decoder = codec.MessageDecoder()
+        self.handlers = {
+            'ServerInfoRequest': self.server_info,
+            'JoinRequest': self.join,
+            'RoomListRequest': self.room_list,
+            'JoinRoomRequest': self.join_room,
+            'ChatMessage': self.chat,
+            'Chat_OOC': self.chat_ooc,
+            'AssetListRequest': self.asset_list,
+            'Goodbye': self.goodbye,
+        }
 
     def connection_made(self, transport: asyncio.Transport):
         """
@@ -24,21 +305,253 @@ class Protocol(asyncio.Protocol):
         client to say something before we drop it off (background
         Internet traffic).
         """
-        self.drop_timer = asyncio.get_event_loop().call_later(4, self.drop_client)
+        self.transport = transport
+        peername = transport.get_extra_info('peername')
+        self.peer = peername[0] if isinstance(peername, tuple) else None
+        if not self.server.admit(self):
+            server_logger.info("Refusing connection from %s", self.peer)
+            transport.abort()
+            return
+        self.admitted = True
+        self.writer = codec.FrameWriter(transport)
+        self.set_deadline(HANDSHAKE_TIMEOUT)
 
     def connection_lost(self, exc: Exception):
         """
         Called on connection loss.
         """
+        if not self.admitted:
+            return
+        self.writer.connection_lost(exc)
+        self.set_deadline(None)
         self.drop_client()
+        self.server.release(self)
+
+    def set_deadline(self, timeout: float = None):
+        """Close the connection unless the handshake is done within `timeout` seconds."""
+        if self.drop_timer is not None:
+            self.drop_timer.cancel()
+            self.drop_timer = None
+        if timeout is not None:
+            self.drop_timer = asyncio.get_event_loop().call_later(timeout, self.handshake_timeout)
+
+    def handshake_timeout(self):
+        self.drop_timer = None
+        self.server.admission.counters['handshake_timeouts'] += 1
+        server_logger.info("Dropping %s: handshake timed out", self.peer)
+        # Do not wait on a peer that may not even be there any more
+        self.transport.abort()
 
     def drop_client(self):
         if self.client is not None:
-            self.server.clients.remove(self.client)
+            if self.handed_off:
+                self.server.release_player(self.client)
+            else:
+                self.server.remove_player(self.client, self.disconnect_cause)
+            self.client = None
+
+    def write(self, message):
+        self.writer.write(message)
+
+    def begin_handoff(self, msg: dict) -> dict:
+        """
+        Stop handling messages, so the connection can be handed to another
+        process along with the returned state. `msg` is the JoinRoomRequest
+        that caused it, for the other process to answer.
+        """
+        self.transport.pause_reading()
+        self.writer.flush()
+        player = self.client
+        self.handoff = {'player_id': player.id, 'name': player.name, 'unique_id': player.unique_id,
+                        'challenge': self.challenge, 'compression': self.writer.compression,
+                        'request': msg, 'backlog': [], 'pending': b''}
+        return self.handoff
+
+    def finish_handoff(self) -> int:
+        """
+        Let go of the connection once everything written was sent. Returns
+        a duplicate of the socket's file descriptor, for the caller to pass
+        on and close.
+        """
+        self.handoff['pending'] = self._decoder.take()
+        fd = os.dup(self.transport.get_extra_info('socket').fileno())
+        self.handed_off = True
+        self.transport.abort()
+        return fd
+
+    def take_over(self, state: dict):
+        """Carry on serving a connection handed over with `state`."""
+        self.set_deadline(None)
+        self.challenge = state['challenge']
+        if state['compression']:
+            self.enable_compression()
+        self.client = self.server.add_player(state['name'], state['unique_id'], self, state['player_id'])
+        self.dispatch([state['request']] + state['backlog'])
+        if state['pending']:
+            self.data_received(state['pending'])
+
+    def reply(self, msg: dict, message: packets.Packet):
+        """Respond to a request, echoing its sequence number."""
+        message.seq = msg.get('seq')
+        self.write(message)
+
+    def enable_compression(self):
+        """Compress large packets both ways (the client offered it)."""
+        self.writer.compression = True
+        self._decoder.compression = True
+
+    def pause_writing(self):
+        self.writer.pause_writing()
+
+    def resume_writing(self):
+        self.writer.resume_writing()
 
     def data_received(self, data: bytes):
-        msg = msgpack.unpackb(data, encoding='utf-8')
-        if msg['id'] == 'ServerInfoRequest':
-            if self.drop_timer is not None:
-                self.drop_timer.cancel()
-        # The rest follows...
\ No newline at end of file
+        try:
+            messages = self._decoder.feed(data)
+        except ProtocolError as e:
+            server_logger.warning("Dropping client: %s", e)
+            self.server.admission.counters['protocol_errors'] += 1
+            self.transport.close()
+            return
+        self.dispatch(messages)
+
+    def dispatch(self, messages: list):
+        for msg in messages:
+            if self.handoff is not None:
+                # Whoever takes over the connection will handle it
+                self.handoff['backlog'].append(msg)
+            else:
+                self.handle_message(msg)
+
+    def handle_message(self, msg: dict):
+        server_logger.debug(msg)
+        handler = self.handlers.get(msg['id'])
+        if handler is not None:
+            handler(msg)
+        elif msg['id'] in self.relayed:
+            self.relay(msg)
+        else:
+            server_logger.warning("Unknown packet %s", msg['id'])
+
+    def server_info(self, msg: dict):
+        if msg.get('type') == packets.ServerInfoRequest.ServerInfoRequestType.PING:
+            self.reply(msg, packets.PingResponse())
+            return
+        if self.client is None:
+            self.set_deadline(JOIN_TIMEOUT)
+        compression = None
+        if codec.COMPRESSION in (msg.get('compression') or ()):
+            self.enable_compression()
+            compression = codec.COMPRESSION
+        server = self.server
+        response = packets.ServerInfoResponse(server.name, server.address, server.port, VERSION,
+                                              server.player_count, server.max_players, server.protection,
+                                              auth_challenge=self.challenge, compression=compression)
+        if msg.get('type') == packets.ServerInfoRequest.ServerInfoRequestType.FULL:
+            response.details = packets.ServerInfoResponse.Details(server.description, server.player_list())
+            response.rooms = server.room_list()
+        self.reply(msg, response)
+
+    def join(self, msg: dict):
+        result = packets.JoinResponse.JoinResult
+        if msg.get('compression') == codec.COMPRESSION:
+            self.enable_compression()
+        if self.client is not None:
+            self.reply(msg, packets.JoinResponse(result.OTHER, "Already joined."))
+            return
+        if self.server.player_count >= self.server.max_players:
+            self.reply(msg, packets.JoinResponse(result.SERVER_FULL))
+            return
+        if self.server.password is not None:
+            expected = password_hash(self.server.password, self.challenge)
+            if not hmac.compare_digest(expected, msg.get('auth_response') or b''):
+                self.reply(msg, packets.JoinResponse(result.BAD_PASSWORD))
+                return
+        name = msg.get('player_name')
+        if not isinstance(name, str) or not name:
+            self.reply(msg, packets.JoinResponse(result.OTHER, "A player name is required."))
+            return
+        self.client = self.server.add_player(name, msg.get('player_id'), self)
+        self.set_deadline(None)
+        self.reply(msg, packets.JoinResponse(result.SUCCESS, player_id=self.client.id))
+
+    def room_list(self, msg: dict):
+        if self.client is None:
+            return
+        self.reply(msg, packets.RoomListResponse(self.server.room_list()))
+
+    def join_room(self, msg: dict):
+        if self.client is None or self.server.route(self, msg):
+            return
+        result = packets.JoinRoomResponse.JoinRoomResult
+        room = self.server.rooms.get(msg.get('room_id'))
+        if room is None:
+            # There is no better result code for this
+            self.reply(msg, packets.JoinRoomResponse(result.ROOM_FULL, "There is no such room."))
+            return
+        if room.full:
+            self.reply(msg, packets.JoinRoomResponse(result.ROOM_FULL))
+            return
+        if room.password is not None:
+            expected = password_hash(room.password, self.challenge)
+            if not hmac.compare_digest(expected, msg.get('auth_response') or b''):
+                self.reply(msg, packets.JoinRoomResponse(result.BAD_PASSWORD))
+                return
+        self.server.join_room(self.client, room)
+        self.reply(msg, packets.JoinRoomResponse(result.SUCCESS))
+
+    def chat(self, msg: dict):
+        player = self.client
+        reason = packets.Rejected.Reason
+        if player is None or player.room is None or msg.get('room_id') != player.room.id:
+            server_logger.debug("Dropping chat message from outside the room")
+            self.reply(msg, packets.Rejected(reason.NOT_IN_ROOM, "You are not in that room."))
+            return
+        if not self.allow_chat():
+            self.reply(msg, packets.Rejected(reason.RATE_LIMITED, "You are sending messages too fast."))
+            return
+        chat = packets.Chat.from_message(msg)
+        chat.player_id = player.id
+        player.room.broadcast(chat, exclude=player)
+        # The sender gets its own copy as the response
+        self.reply(msg, chat)
+
+    def chat_ooc(self, msg: dict):
+        # Out-of-character chat goes to the whole server
+        if self.client is None or not self.allow_chat():
+            return
+        self.server.broadcast(packets.ChatOOC(self.client.id, msg.get('msg')))
+
+    def allow_chat(self) -> bool:
+        if self.chat_bucket.take():
+            return True
+        self.server.admission.counters['rate_limited'] += 1
+        server_logger.debug("Dropping chat message from %s: too fast", self.client.name)
+        return False
+
+    def relay(self, msg: dict):
+        player = self.client
+        if player is None or player.room is None:
+            return
+        player.room.broadcast(self.relayed[msg['id']].from_message(msg))
+
+    def asset_list(self, msg: dict):
+        if self.client is None:
+            return
+        self.reply(msg, packets.AssetListResponse())
+
+    def goodbye(self, msg: dict):
+        self.disconnect_cause = packets.Disconnect.DisconnectCause.DISCONNECT_BY_USER
+        self.transport.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = Server(port=42505)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
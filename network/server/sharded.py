@@ -0,0 +1,432 @@
+"""
+Sharded server: a supervisor process and a number of worker processes.
+
+The supervisor accepts every connection and handles the handshake
+(server info, joining the server, room lists). When a player joins a
+room, its connection is handed over, socket and all, to the worker that
+owns the room; rooms are assigned to workers by consistent hashing.
+Workers hand connections on the same way when a player moves to a room
+owned by another worker, so the busy part (broadcasting to rooms) is
+spread over all of them.
+
+The processes talk over a bus: a Unix SOCK_SEQPACKET socket pair
+between the supervisor and each worker, carrying msgpack maps and, for
+handoffs, file descriptors. The supervisor forwards between workers.
+Packets for the whole server (ChatOOC, Disconnect) are published on it.
+They all go through the supervisor, which numbers them, so that a
+handoff can say which of them the player has already been sent; the
+supervisor adds the ones it missed on the way.
+
+Unix only.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import socket
+from collections import deque
+
+import msgpack
+
+from network import packets
+from network.server.server import Server, Protocol, Room, fan_out
+
+sharded_logger = logging.getLogger("ac.net.server.sharded")
+
+# Largest bus message, and most file descriptors passed with one
+BUS_MESSAGE_SIZE = 1024 * 1024
+BUS_MAX_FDS = 4
+
+# How often to check whether a connection being handed over has sent
+# everything written to it
+HANDOFF_POLL = 0.005
+
+# Packets published to the whole server that the supervisor keeps, for
+# players who were being handed over when they were published
+PUBLISH_HISTORY = 1024
+
+
+class HashRing:
+    """
+    Consistent hashing: each node is placed at `replicas` points on a
+    ring, and a key belongs to the first node at or after its hash. Adding
+    or removing a node only moves the keys next to its points.
+    """
+
+    def __init__(self, nodes, replicas: int = 64):
+        self._ring = sorted((self._hash("{}:{}".format(node, i)), node)
+                            for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], 'little')
+
+    def node_for(self, key):
+        i = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._ring)
+        return self._ring[i][1]
+
+
+class Channel:
+    """
+    One end of the bus. `on_message(msg, fds)` is called for every message
+    received, and with (None, []) once the other end is gone.
+    """
+
+    def __init__(self, sock: socket.socket, on_message):
+        sock.setblocking(False)
+        self.sock = sock
+        self.on_message = on_message
+        self._loop = asyncio.get_event_loop()
+        self._outbox = deque()
+        self._writing = False
+        self._loop.add_reader(sock.fileno(), self._read)
+
+    @property
+    def closed(self) -> bool:
+        return self.sock.fileno() == -1
+
+    def send(self, msg: dict, fds=()):
+        """Send a message. The file descriptors are closed once sent."""
+        if self.closed:
+            for fd in fds:
+                os.close(fd)
+            return
+        self._outbox.append((msgpack.packb(msg, use_bin_type=True), list(fds)))
+        if not self._writing:
+            self._write()
+
+    def close(self):
+        if self.closed:
+            return
+        self._loop.remove_reader(self.sock.fileno())
+        if self._writing:
+            self._loop.remove_writer(self.sock.fileno())
+        for _, fds in self._outbox:
+            for fd in fds:
+                os.close(fd)
+        self._outbox.clear()
+        self.sock.close()
+
+    def _write(self):
+        while self._outbox:
+            data, fds = self._outbox[0]
+            try:
+                socket.send_fds(self.sock, [data], fds)
+            except BlockingIOError:
+                if not self._writing:
+                    self._writing = True
+                    self._loop.add_writer(self.sock.fileno(), self._write)
+                return
+            except OSError as e:
+                sharded_logger.warning("Bus failed: %s", e)
+                self.close()
+                self.on_message(None, [])
+                return
+            self._outbox.popleft()
+            for fd in fds:
+                os.close(fd)
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self.sock.fileno())
+
+    def _read(self):
+        while True:
+            try:
+                data, fds, flags, _ = socket.recv_fds(self.sock, BUS_MESSAGE_SIZE, BUS_MAX_FDS)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                sharded_logger.warning("Bus failed: %s", e)
+                data, fds, flags = b'', [], 0
+            if not data:
+                self.close()
+                self.on_message(None, [])
+                return
+            if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+                sharded_logger.error("Dropping truncated bus message")
+                for fd in fds:
+                    os.close(fd)
+                continue
+            self.on_message(msgpack.unpackb(data, encoding='utf-8'), fds)
+
+
+class _Shard(Server):
+    """What the supervisor and the workers have in common."""
+
+    def __init__(self, ring: HashRing, **kwargs):
+        super().__init__(**kwargs)
+        self.ring = ring
+        # Every room on the server, and how many players each has
+        self.all_rooms = self.rooms
+        self.counts = {room_id: 0 for room_id in self.all_rooms}
+        # Number of the last packet published to the whole server and
+        # delivered here
+        self.seen = 0
+
+    def owner(self, room_id: int):
+        return self.ring.node_for(room_id)
+
+    def room_list(self) -> list:
+        return [dict(room.info(), players=self.counts[room.id]) for room in self.all_rooms.values()]
+
+    def route(self, protocol: Protocol, msg: dict) -> bool:
+        room_id = msg.get('room_id')
+        if room_id not in self.all_rooms or room_id in self.rooms:
+            return False
+        asyncio.ensure_future(self._hand_off(protocol, msg, self.owner(room_id)))
+        return True
+
+    async def _hand_off(self, protocol: Protocol, msg: dict, worker: int):
+        state = protocol.begin_handoff(msg)
+        # Anything still queued or buffered would be lost with the transport.
+        # The player still gets broadcasts meanwhile, so queued frames are
+        # handed to the transport on every check; nothing can be queued
+        # between the last check and finish_handoff.
+        while True:
+            if protocol.transport.is_closing():
+                # The player left meanwhile (see Protocol.drop_client)
+                return
+            protocol.writer.flush()
+            if not protocol.transport.get_write_buffer_size():
+                break
+            await asyncio.sleep(HANDOFF_POLL)
+        fd = protocol.finish_handoff()
+        state['seen'] = self.seen
+        sharded_logger.debug("Handing player %d to worker %d", state['player_id'], worker)
+        self.send_handoff(worker, state, fd)
+
+    def send_handoff(self, worker: int, state: dict, fd: int):
+        raise NotImplementedError
+
+
+class Supervisor(_Shard):
+    """
+    Accepts connections and runs the workers. Takes the same arguments as
+    `Server`, plus the number of workers.
+    """
+
+    def __init__(self, workers: int = None, **kwargs):
+        self.worker_count = workers or os.cpu_count() or 1
+        super().__init__(HashRing(range(self.worker_count)), **kwargs)
+        # The supervisor hosts no rooms itself
+        self.rooms = dict()
+        # Every player on the server, by ID, wherever it is served
+        self.online = dict()
+        # Addresses of the players handed to workers, still counted against
+        # the connection limits until they leave the server
+        self.held = dict()
+        # (number, payload) of the packets published last
+        self.published = deque(maxlen=PUBLISH_HISTORY)
+        self.channels = []
+        self.processes = []
+        self._server_args = kwargs
+
+    async def start(self):
+        # Fork before listening, so the workers do not inherit the socket
+        context = multiprocessing.get_context('fork')
+        pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for _ in range(self.worker_count)]
+        for index, (_, child) in enumerate(pairs):
+            inherited = [sock for pair in pairs for sock in pair if sock is not child]
+            process = context.Process(target=run_worker, name="worker-{}".format(index), daemon=True,
+                                      args=(index, self.ring, child, inherited, self._server_args))
+            process.start()
+            self.processes.append(process)
+        for index, (parent, child) in enumerate(pairs):
+            child.close()
+            self.channels.append(Channel(parent, lambda msg, fds, index=index: self.on_bus(index, msg, fds)))
+        await super().start()
+
+    def close(self):
+        super().close()
+        for channel in self.channels:
+            channel.close()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+    @property
+    def player_count(self) -> int:
+        return len(self.online)
+
+    def player_list(self) -> list:
+        return [{'name': name, 'player_id': player_id} for player_id, name in self.online.items()]
+
+    def release(self, protocol: Protocol):
+        # Only a connection actually sent to a worker is still ours to count
+        if protocol.handed_off:
+            self.held[protocol.handoff['player_id']] = protocol.peer
+        else:
+            super().release(protocol)
+
+    def add_player(self, name: str, unique_id: str, protocol, player_id: int = None):
+        player = super().add_player(name, unique_id, protocol, player_id)
+        self.online[player.id] = player.name
+        return player
+
+    def remove_player(self, player, cause: int = packets.Disconnect.DisconnectCause.UNSPECIFIED):
+        self.online.pop(player.id, None)
+        super().remove_player(player, cause)
+
+    def broadcast(self, packet):
+        self.publish(packet.encode())
+
+    def publish(self, payload: bytes):
+        """Send an encoded packet to every player on the server, in order."""
+        self.seen += 1
+        self.published.append((self.seen, payload))
+        self.deliver(payload)
+        for channel in self.channels:
+            channel.send({'op': 'publish', 'seq': self.seen, 'payload': payload})
+
+    def send_handoff(self, worker: int, state: dict, fd: int):
+        # What was published after the player's last process let go of it
+        # and before the new one hears of it
+        seen = state['seen']
+        if self.published and self.published[0][0] > seen + 1:
+            sharded_logger.warning("Player %d missed packets while being handed over", state['player_id'])
+        state['missed'] = [payload for number, payload in self.published if number > seen]
+        self.channels[worker].send({'op': 'handoff', 'state': state}, [fd])
+
+    def on_bus(self, index: int, msg: dict, fds: list):
+        if msg is None:
+            sharded_logger.error("Worker %d is gone", index)
+            return
+        op = msg['op']
+        if op == 'handoff':
+            self.send_handoff(msg['to'], msg['state'], fds[0])
+        elif op == 'publish':
+            self.publish(msg['payload'])
+        elif op == 'room':
+            self.counts[msg['room_id']] = msg['players']
+            for other, channel in enumerate(self.channels):
+                if other != index:
+                    channel.send(msg)
+        elif op == 'gone':
+            self.online.pop(msg['player_id'], None)
+            if msg['player_id'] in self.held:
+                self.admission.release(self.held.pop(msg['player_id']))
+        else:
+            sharded_logger.warning("Unknown bus message %s", op)
+
+
+class Worker(_Shard):
+    """Serves the rooms the hash ring assigns to it, in its own process."""
+
+    def __init__(self, index: int, ring: HashRing, bus: socket.socket, **kwargs):
+        super().__init__(ring, **kwargs)
+        self.index = index
+        self.rooms = {room_id: room for room_id, room in self.all_rooms.items() if self.owner(room_id) == index}
+        self.channel = Channel(bus, self.on_bus)
+        # For each connection being taken over: what was delivered to the
+        # whole server meanwhile, for it to catch up on
+        self.arriving = []
+
+    async def start(self):
+        sharded_logger.info("Worker %d serving rooms %s", self.index, sorted(self.rooms))
+
+    def admit(self, protocol: Protocol) -> bool:
+        # Only handed-over connections arrive here, already admitted by the supervisor
+        return True
+
+    def release(self, protocol: Protocol):
+        pass
+
+    def close(self):
+        super().close()
+        self.channel.close()
+
+    def broadcast(self, packet):
+        # Delivered here too once the supervisor has numbered it
+        self.channel.send({'op': 'publish', 'payload': packet.encode()})
+
+    def deliver(self, payload: bytes):
+        super().deliver(payload)
+        for missed in self.arriving:
+            missed.append(payload)
+
+    def remove_player(self, player, cause: int = packets.Disconnect.DisconnectCause.UNSPECIFIED):
+        super().remove_player(player, cause)
+        self.channel.send({'op': 'gone', 'player_id': player.id})
+
+    def join_room(self, player, room: Room):
+        super().join_room(player, room)
+        self._update_count(room)
+
+    def leave_room(self, player):
+        room = player.room
+        super().leave_room(player)
+        if room is not None:
+            self._update_count(room)
+
+    def _update_count(self, room: Room):
+        self.counts[room.id] = len(room.members)
+        self.channel.send({'op': 'room', 'room_id': room.id, 'players': len(room.members)})
+
+    def send_handoff(self, worker: int, state: dict, fd: int):
+        self.channel.send({'op': 'handoff', 'to': worker, 'state': state}, [fd])
+
+    def on_bus(self, msg: dict, fds: list):
+        if msg is None:
+            sharded_logger.info("Supervisor is gone, stopping worker %d", self.index)
+            asyncio.get_event_loop().stop()
+            return
+        op = msg['op']
+        if op == 'handoff':
+            # Publishes read along with it are delivered before the task runs
+            missed = list(msg['state']['missed'])
+            self.arriving.append(missed)
+            asyncio.ensure_future(self._take_over(msg['state'], missed, fds[0]))
+        elif op == 'publish':
+            self.seen = msg['seq']
+            self.deliver(msg['payload'])
+        elif op == 'room':
+            self.counts[msg['room_id']] = msg['players']
+        else:
+            sharded_logger.warning("Unknown bus message %s", op)
+
+    async def _take_over(self, state: dict, missed: list, fd: int):
+        sock = socket.socket(fileno=fd)
+        loop = asyncio.get_event_loop()
+        try:
+            _, protocol = await loop.connect_accepted_socket(lambda: Protocol(self), sock)
+        except OSError as e:
+            sharded_logger.warning("Could not take over player %d: %s", state['player_id'], e)
+            sock.close()
+            # The player is gone, as if it had disconnected from here
+            self.broadcast(packets.Disconnect(packets.Disconnect.DisconnectCause.UNSPECIFIED, state['player_id']))
+            self.channel.send({'op': 'gone', 'player_id': state['player_id']})
+            return
+        finally:
+            self.arriving.remove(missed)
+        protocol.take_over(state)
+        if protocol.client is not None:
+            for payload in missed:
+                fan_out([protocol.client], payload)
+
+
+def run_worker(index: int, ring: HashRing, bus: socket.socket, inherited: list, server_args: dict):
+    """Entry point of a worker process."""
+    for sock in inherited:
+        sock.close()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = Worker(index, ring, bus, **server_args)
+    loop.run_until_complete(worker.start())
+    try:
+        loop.run_forever()
+    finally:
+        worker.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = Supervisor(port=42505)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
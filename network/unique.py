@@ -39,4 +39,4 @@ if sys.platform == 'win32':
         return str(uuid.uuid5(NAMESPACE_ANIMATED_CHATROOM, data[-1]))
 else:
     def unique_id():
-        return uuid.uuid5(NAMESPACE_ANIMATED_CHATROOM, str(uuid.getnode()))
\ No newline at end of file
+        return str(uuid.uuid5(NAMESPACE_ANIMATED_CHATROOM, str(uuid.getnode())))
\ No newline at end of file
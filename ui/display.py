@@ -1,16 +1,41 @@
+import logging
+
 import pyglet
 pyglet.options['debug_media'] = True
 pyglet.options['debug_lib'] = True
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import QSize, Qt
 from ui.qpygletwidget import QPygletWidget
 from pyglet import gl
+from pyglet.image.codecs import ImageDecodeException
+from pyglet.media import MediaException
 import core.asset
-from core.scene import Scene
+from core.exceptions import AssetError
+from core.scene import Scene, TRANSITION_NONE
 import core.pylget_loader
 
+display_logger = logging.getLogger("ac.ui.display")
+
+# What loading an asset can raise: manifests are only parsed when first
+# used, and files are only decoded when shown or played
+LOAD_ERRORS = (AssetError, KeyError, IndexError, OSError, ImageDecodeException, MediaException)
+
 
 class Display(QPygletWidget):
 
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Set by the viewport before the widget is shown
+        self.assets = None
+        # Actions may be scheduled from the network thread, even before we
+        # are shown; they run once open gl is initialised
+        self.scene = Scene()
+        self.scene.timeline.wakeup = self.wake.emit
+        # Sprites on screen pin their animations in the cache until they leave it
+        self.scene.layers.on_remove = self._unpin
+        self._pins = dict()
+        # Characters of the players in the room, by player ID
+        self.characters = dict()
+
     def on_init(self):
         #res = pyglet.media.load("R:/adachi.webm")
         #animation = pyglet.image.load_animation("adachi.gif")
@@ -26,12 +51,11 @@ class Display(QPygletWidget):
         #self.player.on_player_next_source = lambda: self.player.queue(res)
         #self.player.loop = True
         #self.player.play()
-        char = core.asset.Character('123456')
-        char.load()
-        self.scene = Scene()
+        # Only the parts of the manifest used below get parsed
+        char = self.assets.get(core.asset.Character, '123456')
         char._open_tars()
         print(char.content_tars)
-        self.scene.layers['background'] = core.pylget_loader.load_animation(char.emotes[0].idle, char.content_tars[char.files[char.emotes[0].idle.filename]])
+        self.scene.layers['background'] = self._load(char, char.emotes[0].idle)
         char._close_tars()
 
         self.label = pyglet.text.Label(
@@ -40,14 +64,141 @@ class Display(QPygletWidget):
             anchor_y='center')
         self.base_width = 256
         self.base_height = 192
+        # Frame timings, toggled with F3
+        self.show_stats = False
+        self.stats_label = pyglet.text.Label(
+            text="", font_size=6, x=2, y=self.base_height - 2,
+            anchor_y='top', multiline=True, width=self.base_width)
+        self.setFocusPolicy(Qt.StrongFocus)
         self.setMinimumSize(QSize(256, 192))
         #self.setMaximumSize(QSize(256, 192))
         self.enable_alpha()
 
+    # The methods below may be called from any thread: they only schedule
+    # actions, which the scene's timeline runs on the GUI thread.
+
+    def join(self, player_id: int, char_id: str):
+        self.scene.timeline.schedule(0, self._join, player_id, char_id)
+
+    def leave(self, player_id: int):
+        self.scene.timeline.schedule(0, self._leave, player_id)
+
+    def chat(self, player_id: int, text: str, emote_name: str):
+        self.scene.timeline.schedule(0, self._chat, player_id, text, emote_name)
+
+    def set_background(self, name: str, transition: dict = None):
+        self.scene.timeline.schedule(0, self._set_background, name, transition)
+
+    def play_sound(self, name: str, channel: int, loop: bool = False):
+        self.scene.timeline.schedule(0, self._play_sound, name, channel, loop)
+
+    def stop_sound(self, channel: int):
+        self.scene.stop_sound(channel)
+
+    def _join(self, player_id: int, char_id: str):
+        if char_id is None:
+            return
+        try:
+            character = self.assets.get(core.asset.Character, char_id)
+            if character.content_tars is None:
+                character._open_tars()
+        except LOAD_ERRORS as e:
+            display_logger.warning("Cannot show character %s: %s", char_id, e)
+            return
+        self.characters[player_id] = character
+
+    def _leave(self, player_id: int):
+        character = self.characters.pop(player_id, None)
+        # Other players may use the same character
+        if character is not None and character not in self.characters.values():
+            character._close_tars()
+            # Let go of its animations, unless they are still on screen
+            core.pylget_loader.animation_cache().clear()
+
+    def _chat(self, player_id: int, text: str, emote_name: str):
+        character = self.characters.get(player_id)
+        if character is None:
+            # We do not know what the player looks like
+            self._show_text(text)
+            return
+        try:
+            emote = next((emote for emote in character.emotes if emote.name == emote_name), character.emotes[0])
+        except LOAD_ERRORS as e:
+            display_logger.warning("Cannot show emote %s of %s: %s", emote_name, character.id, e)
+            self._show_text(text)
+            return
+
+        def load(animation):
+            try:
+                return self._load(character, animation)
+            except LOAD_ERRORS as e:
+                display_logger.warning("Cannot show %s of %s: %s", animation.filename, character.id, e)
+                return None
+
+        self.scene.play_chat(emote, text, load, on_text=self._show_text)
+
+    def _show_text(self, text: str):
+        self.label.text = text
+
+    def _set_background(self, name: str, transition: dict):
+        try:
+            background = self.assets.get(core.asset.Background, name)
+            # The packet does not say which side to show
+            animation = background.sides[0].animation
+            background._open_tars()
+            try:
+                sprite = self._load(background, animation)
+            finally:
+                background._close_tars()
+        except LOAD_ERRORS as e:
+            display_logger.warning("Cannot show background %s: %s", name, e)
+            return
+        transition = transition or dict()
+        self.scene.set_background(sprite, transition.get('type', TRANSITION_NONE), transition.get('time', 0))
+
+    def _play_sound(self, name: str, channel: int, loop: bool):
+        try:
+            audio = self.assets.get(core.asset.Audio, name)
+            filename = audio.filename
+            audio._open_tars()
+            try:
+                with audio.content_tars[audio.files[filename]].extractfile(filename) as f:
+                    source = pyglet.media.load(filename, file=f, streaming=False)
+            finally:
+                audio._close_tars()
+        except LOAD_ERRORS as e:
+            display_logger.warning("Cannot play %s: %s", name, e)
+            return
+        self.scene.play_sound(source, channel, loop)
+
+    def _load(self, asset, animation) -> pyglet.sprite.Sprite:
+        """Load a sprite to put on screen, keeping its animation cached while it is there."""
+        archive = asset.content_tars[asset.files[animation.filename]]
+        sprite = core.pylget_loader.load_animation(animation, archive, pin=True)
+        self._pins[sprite] = core.pylget_loader.animation_key(animation, archive)
+        return sprite
+
+    def _unpin(self, layer):
+        key = self._pins.pop(layer, None)
+        if key is not None:
+            core.pylget_loader.animation_cache().unpin(key)
+
+    def on_update(self, dt):
+        if self.scene.update():
+            self.request_redraw()
+
+    def next_deadline(self):
+        deadline = self.scene.timeline.next_deadline()
+        if deadline is None:
+            return None
+        return max(0.0, deadline - self.scene.timeline.clock())
+
     def on_draw(self):
-        pyglet.app.event_loop.idle()
         self.label.draw()
         self.scene.draw()
+        if self.show_stats:
+            self.stats_label.text = self.profiler.summary()
+            self.stats_label.draw()
         #self.player.texture.blit(0, 0, width=self.base_width, height=self.base_height)
         #self.sprite.draw()
 
@@ -60,6 +211,22 @@ class Display(QPygletWidget):
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
         gl.glScalef(scale, scale, scale)
 
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_F3:
+            self.show_stats = not self.show_stats
+            self.request_redraw()
+        elif event.key() == Qt.Key_F4:
+            self.export_trace('frame_trace.json')
+        else:
+            super().keyPressEvent(event)
+
+    def export_trace(self, path: str):
+        """Export the recent frame timings, as CSV if `path` ends in .csv, else JSON."""
+        if path.endswith('.csv'):
+            self.profiler.export_csv(path)
+        else:
+            self.profiler.export_json(path)
+
     def enable_alpha(self):
         gl.glEnable(gl.GL_BLEND)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
\ No newline at end of file
@@ -5,8 +5,14 @@ import logging
 
 from PyQt5 import QtCore, QtWidgets, uic, QtGui
 
+from core.asset import Character, Background, Audio, Evidence
+from core.exceptions import AssetError
+from core.registry import AssetRegistry, load_assets
 from network import packets
 from network.client.client import Client, ClientHandler
+from network.client.probe import Prober, ProbeResult
+from network.exceptions import ProtocolError
+from network.master.client import MasterClient
 from . import show_exception_dialog
 from .main import MainWindow
 
@@ -14,21 +20,99 @@ ui_logger = logging.getLogger("ac.ui.lobby")
 
 
 class Lobby(QtWidgets.QMainWindow):
+
+    master_refreshed = QtCore.pyqtSignal(list, list)
+    master_refresh_failed = QtCore.pyqtSignal(Exception)
+    server_pinged = QtCore.pyqtSignal(ProbeResult)
+
     def __init__(self):
         super().__init__()
-        self.master_server = None
+        self.master_server = MasterClient()
         self.client_threads = set()
         self.windows = []
         uic.loadUi("ui/lobby.ui", self)
+        # Master server listings, their rows and their latest pings, by key
+        self.master_servers_model = QtGui.QStandardItemModel(self)
+        self.master_server_items = dict()
+        self.master_server_pings = dict()
+        self.list_master_servers.setModel(self.master_servers_model)
+        self.master_refreshed.connect(self._master_list_refreshed)
+        self.master_refresh_failed.connect(self._master_refresh_failed)
+        self.server_pinged.connect(self._server_pinged)
+        self.prober = Prober()
+        # The refresh in progress (pings included), as a concurrent future
+        self._master_refresh = None
+        self.network = NetworkThread()
+        self.network.start()
         self.show()
 
     def closeEvent(self, event):
         for client_thread in self.client_threads:
             client_thread.stop()
+        if self._master_refresh is not None:
+            self._master_refresh.cancel()
+        self.network.loop.call_soon_threadsafe(self.master_server.close)
+        self.network.stop()
 
     def master_server_refresh(self):
+        if self._master_refresh is not None:
+            self._master_refresh.cancel()
+        self.button_master_refresh.setEnabled(False)
+        self._master_refresh = self.network.submit(self._refresh_master_list())
+
+    async def _refresh_master_list(self):
+        # Runs on the network thread; the results go back through signals
+        try:
+            changed, removed = await self.master_server.refresh()
+        except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+            self.master_refresh_failed.emit(e)
+            return
+        self.master_refreshed.emit(changed, removed)
+        # Ping every listed server, showing each as soon as it answers
+        servers = [(server['address'], server['port']) for server in self.master_server.servers.values()]
+        await self.prober.probe_all(servers, self.server_pinged.emit)
+
+    def _master_list_refreshed(self, changed: list, removed: list):
+        for key in removed:
+            self.master_server_pings.pop(key, None)
+            item = self.master_server_items.pop(key, None)
+            if item is not None:
+                self.master_servers_model.removeRow(item.row())
+        for server in changed:
+            item = self.master_server_items.get(server['key'])
+            if item is None:
+                item = self.master_server_items[server['key']] = QtGui.QStandardItem()
+                item.setEditable(False)
+                self.master_servers_model.appendRow(item)
+            item.setToolTip(server['description'] or "")
+            item.setData(server, QtCore.Qt.UserRole)
+            self._update_master_item(item)
+        self.button_master_refresh.setEnabled(True)
+
+    def _server_pinged(self, result: ProbeResult):
+        item = self.master_server_items.get(result.key)
+        if item is None:
+            return
+        if result.error is None:
+            self.master_server_pings[result.key] = "{:.0f} ms".format(result.rtt * 1000)
+        else:
+            self.master_server_pings[result.key] = "unreachable"
+        self._update_master_item(item)
+
+    def _update_master_item(self, item: QtGui.QStandardItem):
+        server = item.data(QtCore.Qt.UserRole)
+        text = "{} ({}/{})".format(server['name'], server['player_count'], server['max_players'])
+        ping = self.master_server_pings.get(server['key'])
+        if ping is not None:
+            text += " — " + ping
+        item.setText(text)
+
+    def _master_refresh_failed(self, exc: Exception):
+        self.button_master_refresh.setEnabled(True)
         msgbox = QtWidgets.QMessageBox()
-        msgbox.critical(self, "Error", "Master server doesn't exist yet, dummy.", QtWidgets.QMessageBox.Help)
+        msgbox.warning(self, "Master Server",
+                       "Could not get the server list:\n{}".format(str(exc) or "Disconnected"),
+                       QtWidgets.QMessageBox.Ok)
 
     def server_add_to_favorites(self):
         msgbox = QtWidgets.QMessageBox()
@@ -67,6 +151,9 @@ class Lobby(QtWidgets.QMainWindow):
         client_thread.error.connect(loading.error, QtCore.Qt.BlockingQueuedConnection)
         client_thread.set_status.connect(loading.set_status)
         client_thread.set_progress.connect(loading.set_progress)
+        client_thread.show_subprogress.connect(loading.show_subprogress)
+        client_thread.set_substatus.connect(loading.set_substatus)
+        client_thread.set_subprogress.connect(loading.set_subprogress)
         client_thread.thread_end.connect(self._thread_stopped)
 
         client.handler = Loading.LoadingHandler(client, client_thread)
@@ -74,8 +161,8 @@ class Lobby(QtWidgets.QMainWindow):
         thread_id_future.add_done_callback(lambda: self.client_threads.add(client_thread))
         loading.show()
 
-    def _connect_success(self, client):
-        self.windows.append(MainWindow(client, None))
+    def _connect_success(self, client, assets):
+        self.windows.append(MainWindow(client, assets))
         # self.main.show()
         # Code below causes application to close.
         # self.hide()
@@ -85,6 +172,28 @@ class Lobby(QtWidgets.QMainWindow):
         ui_logger.debug("Discarded thread %d from thread list.", thread.thread_id)
 
 
+class NetworkThread(QtCore.QThread):
+    """
+    Runs one event loop for the lobby's own networking (the master server
+    list), apart from the threads of the game server connections.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Run a coroutine on the loop. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
 class ClientThread(QtCore.QThread):
 
     client_logger = logging.getLogger("ac.t.client")
@@ -110,6 +219,9 @@ class ClientThread(QtCore.QThread):
         self._parent = parent
         self._thread_id_future = thread_id_future
 
+        # Installed assets, verified while connecting.
+        self.assets = AssetRegistry()
+
         # To be populated after the thread starts.
         self.thread_id = None
 
@@ -178,10 +290,29 @@ class ClientThread(QtCore.QThread):
 
         # TODO: download assets
 
+        self.set_status.emit("Verifying assets...")
+        self.set_progress.emit(60)
+        await self.loop.run_in_executor(None, self._load_assets)
+
         self.set_status.emit("Loading client...")
         self.set_progress.emit(90)
         self.success.emit()
 
+    def _load_assets(self):
+        """Verify and index every installed asset, reporting on the sub-progress bar."""
+        self.show_subprogress.emit(True)
+        for asset_type in (Character, Background, Audio, Evidence):
+            self.set_substatus.emit("Verifying {}...".format(asset_type.category))
+            self.set_subprogress.emit(0)
+            for asset_id, future in load_assets(asset_type.installed(), asset_type, self.assets,
+                                                progress=lambda done, total:
+                                                self.set_subprogress.emit(done * 100 // total)):
+                try:
+                    future.result()
+                except (AssetError, OSError) as e:
+                    self.client_logger.warning("Skipping %s %s: %s", asset_type.category, asset_id, e)
+        self.show_subprogress.emit(False)
+
     async def _ask_password(self):
         future = asyncio.Future()
         self.open_password_dialog.emit(future)
@@ -194,7 +325,7 @@ class ClientThread(QtCore.QThread):
 
 class Loading(QtWidgets.QDialog):
 
-    open_main = QtCore.pyqtSignal(Client)
+    open_main = QtCore.pyqtSignal(Client, AssetRegistry)
 
     def __init__(self, client: Client, parent=None):
         QtWidgets.QDialog.__init__(self, parent)
@@ -243,7 +374,7 @@ class Loading(QtWidgets.QDialog):
 
     def success(self):
         self.widget_subdownload.hide()
-        self.open_main.emit(self.client)
+        self.open_main.emit(self.client, self.client.thread.assets)
         self.close()
         self.deleteLater()
 
@@ -262,6 +393,16 @@ class Loading(QtWidgets.QDialog):
     def set_progress(self, val: int):
         self.progress_loading.setValue(val)
 
+    def show_subprogress(self, val: bool):
+        self.widget_subdownload.setVisible(val)
+        self.adjustSize()
+
+    def set_substatus(self, val: str):
+        self.label_substatus.setText(val)
+
+    def set_subprogress(self, val: int):
+        self.progress_subdownload.setValue(val)
+
     def cancel(self):
         ui_logger.info("Canceling loading process!")
         self.client.close()
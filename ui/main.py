@@ -6,18 +6,22 @@ from .viewport import Viewport
 from .sound_mixer import SoundMixer
 from .ooc import OOCChat
 from .ic import ICChat
-from network.client.client import Client
+from core.registry import AssetRegistry
+from network.client.client import Client, ClientHandler
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, client: Client, parent=None):
+    def __init__(self, client: Client, assets: AssetRegistry, parent=None):
         super().__init__(parent)
         uic.loadUi("ui/main.ui", self)
 
         self.client = client
+        # Installed assets, loaded while connecting
+        self.assets = assets
         self.client.thread.on_disconnect.connect(self.on_disconnect)
         self.client.thread.on_exception.connect(self.on_exception)
-        self.viewport = Viewport(self)
+        self.viewport = Viewport(self, assets)
+        self.client.handler = MainWindow.MainHandler(client, client.thread, self.viewport.widget)
 
         # Windows/dock widgets: a mapping from widget type to the actual
         # object
@@ -38,6 +42,39 @@ class MainWindow(QtWidgets.QMainWindow):
                             QtWidgets.QMessageBox.Ok)
             self.close()
 
+    class MainHandler(ClientHandler):
+        """Plays what happens in the room on the display."""
+
+        def __init__(self, client: Client, thread: QtCore.QThread, display):
+            super().__init__(client)
+            self._thread = thread
+            self._display = display
+
+        def handle_disconnect(self):
+            super().handle_disconnect()
+            self._thread.on_disconnect.emit()
+
+        def Join(self, msg: dict):
+            self._display.join(msg['player_id'], msg.get('char_id'))
+
+        def Leave(self, msg: dict):
+            self._display.leave(msg['player_id'])
+
+        def Disconnect(self, msg: dict):
+            self._display.leave(msg['player_id'])
+
+        def ChatMessage(self, msg: dict):
+            self._display.chat(msg.get('player_id'), msg.get('text'), msg.get('emote'))
+
+        def SetBackground(self, msg: dict):
+            self._display.set_background(msg['name'], msg.get('transition'))
+
+        def SoundPlay(self, msg: dict):
+            self._display.play_sound(msg['name'], msg['channel'], bool(msg.get('loop')))
+
+        def SoundStop(self, msg: dict):
+            self._display.stop_sound(msg['channel'])
+
     def on_disconnect(self):
         msgbox = QtWidgets.QMessageBox(self)
         msgbox.setWindowTitle("Disconnected")
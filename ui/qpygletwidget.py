@@ -7,12 +7,15 @@ It also provides a basic usage example.
 Source: https://github.com/ColinDuquesnoy/QPygletWidget
 License: No restrictions
 """
+import math
 import sys
+import time
 import pyglet
 pyglet.options['shadow_window'] = False
 pyglet.options['debug_gl'] = False
 from pyglet import gl
 from PyQt5 import QtCore, QtGui, QtOpenGL, QtWidgets
+from core.profiler import FrameProfiler
 
 
 class ObjectSpace(object):
@@ -79,47 +82,132 @@ class QPygletWidget(QtOpenGL.QGLWidget):
 
     User can subclass this widget and implement the following methods:
         - on_init: called when open gl has been initialised
-        - on_update: called every dt.
+        - on_update: called with the elapsed time on every tick.
         - on_draw: called when paintGL is executed
         - on_resize: called when resizeGL is executed
+        - next_deadline: seconds until the next tick is needed, or None
+
+    Update, draw and buffer swap times of every frame (and texture uploads
+    made meanwhile) are recorded in `profiler`.
+
+    Nothing runs on a fixed timer: the widget ticks when a pyglet clock
+    item (e.g. the next frame of an animated sprite) or `next_deadline`
+    is due, and only redraws when a clock item ran or `request_redraw`
+    was called. When nothing is pending it sleeps until `request_redraw`
+    (or `wake`, from other threads).
     """
+
+    # Emit from any thread to get the widget to tick again.
+    wake = QtCore.pyqtSignal()
+
     def __init__(self, parent=None,
                  clear_color=(0.0, 0.0, 0.0, 1.0),
-                 frame_time=32,
-                 dt=16):
+                 frame_time=16,
+                 vsync=False):
         """
         :param clear_color: The widget clear color
         :type clear_color: tuple(r, g, b, a)
 
-        :param frame_time: The desired frame time [ms]
+        :param frame_time: The minimum time between two frames [ms]
         :type: frame_time: int
 
-        :param dt: The desired update rate [ms]
-        :type: dt: int
+        :param vsync: Lock redraws to the display refresh rate instead of
+            frame_time
+        :type: vsync: bool
         """
-        QtOpenGL.QGLWidget.__init__(self, parent)
+        gl_format = QtOpenGL.QGLFormat.defaultFormat()
+        gl_format.setSwapInterval(1 if vsync else 0)
+        QtOpenGL.QGLWidget.__init__(self, gl_format, parent)
+        # Swap in paintGL so that the swap can be timed
+        self.setAutoBufferSwap(False)
+        self.profiler = FrameProfiler()
 
         # init members
         self._clear_color = clear_color
-        self._dt = dt
-        self.update_timer = QtCore.QTimer()
-        self.draw_timer = QtCore.QTimer()
-
-        # configure draw and update timers
-        self.update_timer.setInterval(dt)
-        self.update_timer.timeout.connect(self._update)
-        self.draw_timer.setInterval(frame_time)
-        self.draw_timer.timeout.connect(self.updateGL)
-
-        # start timers
-        self.update_timer.start()
-        self.draw_timer.start()
+        self._frame_time = frame_time / 1000
+        self._vsync = vsync
+        self._dirty = True
+        self._initialized = False
+        self._ticking = False
+        self._last_tick = time.monotonic()
+        self._last_frame = 0
+
+        # configure the tick timer, which is re-armed for the next deadline
+        self.tick_timer = QtCore.QTimer()
+        self.tick_timer.setSingleShot(True)
+        self.tick_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.tick_timer.timeout.connect(self._tick)
+        self.wake.connect(self.request_redraw)
+
+        # ticking starts once open gl has been initialised
+
+    def request_redraw(self):
+        """
+        Marks the scene as changed, so it is redrawn on the next tick.
+        Only call this from the GUI thread; emit `wake` otherwise.
+        """
+        self._dirty = True
+        if not self._ticking:
+            self._schedule(0)
 
-    def _update(self):
+    def _tick(self):
+        """
+        Updates, runs due pyglet clock items, redraws if anything changed
+        and arms the timer for the next deadline.
+        """
+        if not self._initialized:
+            return
+        now = time.monotonic()
+        self.makeCurrent()
+        gl.current_context = self._pyglet_context
+        self.profiler.make_current()
+        with self.profiler.section('update'):
+            self._ticking = True
+            try:
+                self.on_update(now - self._last_tick)
+            finally:
+                self._ticking = False
+            clock = pyglet.clock.get_default()
+            if clock.call_scheduled_functions(clock.update_time()):
+                self._dirty = True
+        self._last_tick = now
+        if self._dirty:
+            self._dirty = False
+            self.updateGL()
+            self._last_frame = time.monotonic()
+        self._schedule_next()
+
+    def _schedule_next(self):
+        delays = []
+        clock_delay = pyglet.clock.get_default().get_sleep_time(True)
+        if clock_delay is not None:
+            delays.append(clock_delay)
+        deadline = self.next_deadline()
+        if deadline is not None:
+            delays.append(deadline)
+        if self._dirty:
+            delays.append(0)
+        if not delays:
+            # Idle: sleep until someone requests a redraw
+            return
+        delay = min(delays)
+        if not self._vsync:
+            # With vsync, buffer swaps already pace the frames
+            delay = max(delay, self._last_frame + self._frame_time - time.monotonic())
+        self._schedule(delay)
+
+    def _schedule(self, delay):
+        msec = max(0, math.ceil(delay * 1000))
+        if self.tick_timer.isActive() and self.tick_timer.remainingTime() <= msec:
+            return
+        self.tick_timer.start(msec)
+
+    def next_deadline(self):
         """
-        Calls on_update with the choosen dt
+        Lets the user tell when the widget must tick again, in seconds
+        from now, or None if nothing is pending
         """
-        self.on_update(self._dt)
+        return None
 
     def on_init(self):
         """
@@ -156,22 +244,37 @@ class QPygletWidget(QtOpenGL.QGLWidget):
             - create a mock context to fool pyglet
             - setup various opengl rule (only the clear color atm)
         """
-        gl.current_context = Context()
+        # Keep our own mock context so that per-context resources (e.g.
+        # texture atlases) stay apart when several widgets exist.
+        self._pyglet_context = Context()
+        gl.current_context = self._pyglet_context
+        self.profiler.make_current()
         gl.glClearColor(0.0, 0.0, 0.0, 1.0)
         self.on_init()
+        self._initialized = True
+        self._last_tick = time.monotonic()
+        self.request_redraw()
 
     def resizeGL(self, w, h):
         """
         Resizes the gl camera to match the widget size.
         """
+        gl.current_context = self._pyglet_context
+        self.profiler.make_current()
         self.on_resize(w, h)
 
     def paintGL(self):
         """
         Clears the back buffer than calls the on_draw method
         """
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
-        self.on_draw()
+        gl.current_context = self._pyglet_context
+        self.profiler.make_current()
+        with self.profiler.section('draw'):
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            self.on_draw()
+        with self.profiler.section('swap'):
+            self.swapBuffers()
+        self.profiler.end_frame()
 
 
 class MyPygletWidget(QPygletWidget):
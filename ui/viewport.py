@@ -1,8 +1,12 @@
 from PyQt5 import QtWidgets, uic
 
+from core.registry import AssetRegistry
+
 
 class Viewport(QtWidgets.QWidget):
-    def __init__(self, parent):
+    def __init__(self, parent, assets: AssetRegistry):
         super(Viewport, self).__init__(parent)
         uic.loadUi("ui/viewport.ui", self)
-        self.show()
\ No newline at end of file
+        # The display is set up once shown, with the assets loaded while connecting
+        self.widget.assets = assets
+        self.show()